@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Mar 26 16:20:31 2023
+
+@author: Magdalena Schneider, Janelia Research Campus
+
+Benchmarks of the Ripley's pipeline on synthetic masks and point patterns, with regression checks against a stored baseline
+"""
+
+import sys
+import json
+import time
+import platform
+import tracemalloc
+import numpy as np
+import scipy
+import maskModule as mm
+import ripleysModule as rm
+import countingModule as cnt
+
+BENCHMARK_VERSION = 1 # increase whenever stages or patterns change, results of different versions are not compared
+
+
+#%% Synthetic data
+
+def createDiscMask(nPixels=512, pixelsize=130, radiusFraction=0.45):
+    y, x = np.mgrid[0:nPixels, 0:nPixels]
+    center = (nPixels - 1) / 2
+    maskData = ((x - center)**2 + (y - center)**2) <= (radiusFraction*nPixels)**2
+    return mm.Mask(maskData, pixelsize)
+
+def csrPattern(nPoints, cellMask, rng):
+    points, *__ = cellMask.randomPoints(nPoints, rng=rng)
+    return points
+
+def clusterPattern(nPoints, cellMask, rng, kernel='thomas', clusterSize=50, pointsPerCluster=20, parents=None):
+    # Thomas (Gaussian offspring, sd clusterSize) or Matern (uniform offspring in a disc of radius clusterSize) cluster process.
+    # Offspring outside of the mask are replaced, so exactly nPoints are returned.
+    if parents is None:
+        parents = csrPattern(max(nPoints // pointsPerCluster, 1), cellMask, rng)
+    points = np.zeros((0, 2))
+    while len(points) < nPoints:
+        nMissing = nPoints - len(points)
+        centers = parents[rng.integers(len(parents), size=nMissing)]
+        if kernel == 'thomas':
+            offsets = rng.normal(scale=clusterSize, size=(nMissing, 2))
+        elif kernel == 'matern':
+            angle = rng.uniform(0, 2*np.pi, nMissing)
+            radius = clusterSize * np.sqrt(rng.uniform(0, 1, nMissing))
+            offsets = np.column_stack((radius*np.cos(angle), radius*np.sin(angle)))
+        else:
+            raise ValueError('Invalid cluster kernel, use "thomas" or "matern".')
+        candidates = centers + offsets
+        points = np.vstack((points, candidates[cellMask.contains(candidates)]))
+    return points
+
+def coClusteredPatterns(nPoints, cellMask, rng, kernel='thomas', clusterSize=50, pointsPerCluster=20):
+    # Two cluster patterns around the same parents
+    parents = csrPattern(max(nPoints // pointsPerCluster, 1), cellMask, rng)
+    return [clusterPattern(nPoints, cellMask, rng, kernel, clusterSize, parents=parents) for _ in range(2)]
+
+def createPatterns(pattern, nPoints, cellMask, rng):
+    # Pair of point sets, co-clustered for 'cocluster', independent otherwise
+    if pattern == 'csr':
+        return [csrPattern(nPoints, cellMask, rng) for _ in range(2)]
+    if pattern in ('thomas', 'matern'):
+        return [clusterPattern(nPoints, cellMask, rng, kernel=pattern) for _ in range(2)]
+    if pattern == 'cocluster':
+        return coClusteredPatterns(nPoints, cellMask, rng)
+    raise ValueError('Invalid pattern, use "csr", "thomas", "matern" or "cocluster".')
+
+
+#%% Stages
+
+def runMultiAnalysis(pointSets, cellMask, radii, nControls, **controlOptions):
+    # Analysis of all pairs of point sets as in performRipleysMultiAnalysis, without file input and figures
+    nFiles = len(pointSets)
+    dataCounts = cnt.countPairMatrix(pointSets, radii, backend=controlOptions.get('backend', 'auto'))
+    ripleysIntegrals = np.zeros((nFiles, nFiles))
+    for j in range(nFiles):
+        for k in range(nFiles):
+            if j == k:
+                results = rm.RipleysAnalysis(pointSets[j], radii, cellMask, nControls, dataCounts=dataCounts[j,k], **controlOptions)
+            else:
+                results = rm.CrossRipleysAnalysis(pointSets[j], pointSets[k], radii, cellMask, nControls,
+                                                  dataCounts=dataCounts[j,k], **controlOptions)
+            ripleysIntegrals[j,k] = results.ripleysIntegral_data
+    return ripleysIntegrals
+
+def getStages(pointSets, cellMask, radii, nControls, seed=0, **controlOptions):
+    # (setup, function) per stage, setup runs once before the stage is measured
+    nPoints = len(pointSets[0])
+    interface = rm.RipleysInterface(radii, cellMask, nControls, seed=seed, **controlOptions)
+    K = interface.getRipleysCurves(pointSets[0], area=cellMask.area)['K']
+
+    def setupControls():
+        interface.ripleysCurves_controls = interface.getRipleysRandomControlCurves(nPoints, cellMask)
+
+    def normalizeCurve():
+        interface.envelopes = {} # include the envelope quantiles
+        return interface.normalizeCurve(K)
+
+    return {'randomPoints': (None, lambda: cellMask.randomPoints(nPoints, rng=np.random.default_rng(seed))),
+            'getRipleysCurves': (None, lambda: interface.getRipleysCurves(pointSets[0], area=cellMask.area)),
+            'getRipleysRandomControlCurves': (None, lambda: interface.getRipleysRandomControlCurves(nPoints, cellMask)),
+            'normalizeCurve': (setupControls, normalizeCurve),
+            'multiAnalysis': (None, lambda: runMultiAnalysis(pointSets, cellMask, radii, nControls, seed=seed, **controlOptions))}
+
+
+#%% Measurement
+
+def measure(function, repeats=3, setup=None):
+    # Minimum wall time over repeats, and peak memory allocated during one extra run (numpy allocations are traced)
+    if setup is not None:
+        setup()
+    times = []
+    for _ in range(repeats):
+        tstart = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - tstart)
+    tracemalloc.start()
+    try:
+        function()
+        __, peakMemory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'time': min(times), 'peakMemory': peakMemory}
+
+def runBenchmarks(patterns=('csr', 'thomas', 'matern', 'cocluster'), sizes=(10**3, 10**4, 10**5), stages=None, radii=None,
+                  nControls=10, repeats=3, maxPoints=None, nPixels=512, pixelsize=130, seed=0, **controlOptions):
+    # maxPoints: largest number of points per stage, larger sizes are skipped for that stage (e.g. {'multiAnalysis': 10**6})
+    if radii is None:
+        radii = np.concatenate((np.arange(4, 80, 2), np.arange(80, 201, 12)))
+    if maxPoints is None:
+        maxPoints = {}
+    cellMask = createDiscMask(nPixels, pixelsize)
+    config = {'patterns': list(patterns), 'sizes': [int(nPoints) for nPoints in sizes], 'radii': np.asarray(radii, dtype=float).tolist(),
+              'nControls': nControls, 'repeats': repeats, 'nPixels': nPixels, 'pixelsize': pixelsize, 'seed': seed,
+              'controlOptions': {name: str(value) for name, value in controlOptions.items()}}
+    results = []
+    for pattern in patterns:
+        for nPoints in sizes:
+            pointSets = createPatterns(pattern, int(nPoints), cellMask, np.random.default_rng(seed))
+            stageFunctions = getStages(pointSets, cellMask, radii, nControls, seed=seed, **controlOptions)
+            for stage in (stages or stageFunctions):
+                if nPoints > maxPoints.get(stage, np.inf):
+                    continue
+                print(f'Benchmark {stage} on {pattern} with {nPoints} points...')
+                setup, function = stageFunctions[stage]
+                result = measure(function, repeats, setup)
+                results.append(dict(pattern=pattern, nPoints=int(nPoints), stage=stage, **result))
+    return {'version': BENCHMARK_VERSION, 'metadata': getMetadata(), 'config': config, 'results': results}
+
+def getMetadata():
+    return {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0], 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'platform': platform.platform(), 'processor': platform.processor()}
+
+
+#%% Baseline comparison
+
+def saveBenchmarks(file, benchmarks):
+    with open(file, 'w') as f:
+        json.dump(benchmarks, f, indent=2)
+
+def loadBenchmarks(file):
+    with open(file) as f:
+        return json.load(f)
+
+def compareBenchmarks(benchmarks, baseline, timeTolerance=0.2, memoryTolerance=0.2, minTime=0.01):
+    # Regressions: stages that got slower (or used more memory) than the baseline by more than the relative tolerance.
+    # Times below minTime seconds are too noisy to compare.
+    if benchmarks['version'] != baseline['version']:
+        raise ValueError(f'Benchmark version {benchmarks["version"]} cannot be compared with baseline version {baseline["version"]}.')
+    baselineResults = {getResultKey(result): result for result in baseline['results']}
+    regressions = []
+    for result in benchmarks['results']:
+        reference = baselineResults.get(getResultKey(result))
+        if reference is None:
+            continue
+        checks = [('time', timeTolerance, max(reference['time'], result['time']) >= minTime),
+                  ('peakMemory', memoryTolerance, True)]
+        for metric, tolerance, comparable in checks:
+            if comparable and (result[metric] > (1 + tolerance) * reference[metric]):
+                regressions.append({'pattern': result['pattern'], 'nPoints': result['nPoints'], 'stage': result['stage'], 'metric': metric,
+                                    'baseline': reference[metric], 'current': result[metric], 'ratio': result[metric] / max(reference[metric], 1e-12)})
+    return regressions
+
+def getResultKey(result):
+    return (result['pattern'], result['nPoints'], result['stage'])
+
+def printBenchmarks(benchmarks):
+    print(f'{"pattern":>10} {"nPoints":>10} {"stage":>30} {"time (s)":>10} {"memory (MB)":>12}')
+    for result in benchmarks['results']:
+        print(f'{result["pattern"]:>10} {result["nPoints"]:>10} {result["stage"]:>30} {result["time"]:>10.4f} {result["peakMemory"]/1024**2:>12.1f}')
+
+def printRegressions(regressions):
+    if not regressions:
+        print('No regressions compared to baseline')
+    for regression in regressions:
+        print(f'Regression in {regression["stage"]} ({regression["pattern"]}, {regression["nPoints"]} points): '
+              f'{regression["metric"]} {regression["baseline"]:.4g} -> {regression["current"]:.4g} ({regression["ratio"]:.2f}x)')
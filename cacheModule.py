@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Feb 11 14:05:12 2023
+
+@author: Magdalena Schneider, Janelia Research Campus
+
+Content-addressed cache for random control curves
+"""
+
+import os
+import glob
+import json
+import pickle
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import scipy
+import countingModule as cnt
+
+CONTROL_VERSION = 2 # increase whenever the generation of random controls changes
+
+
+class ControlCache:
+    def __init__(self, path=None, maxBytes=2*1024**3, maxMemoryItems=256):
+        self.path = path # folder of the disk layer, None for memory only
+        self.maxBytes = maxBytes # size limit of the disk layer, least recently used entries are evicted
+        self.maxMemoryItems = maxMemoryItems
+        self.memory = OrderedDict()
+        if (path is not None) and (not os.path.exists(path)):
+            os.makedirs(path)
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.path is None:
+            return None
+        file = self.getFile(key)
+        try:
+            with np.load(file) as npz:
+                value = {name: npz[name] for name in npz.files}
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(file) # mark as recently used
+        except FileNotFoundError:
+            pass # evicted by another process sharing the cache, the loaded value is still valid
+        self.putMemory(key, value)
+        return value
+
+    def put(self, key, value):
+        self.putMemory(key, value)
+        if self.path is None:
+            return
+        writeAtomic(self.getFile(key), lambda f: np.savez(f, **value)) # concurrent runs never read partial entries
+        self.evict()
+
+    def putMemory(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxMemoryItems:
+            self.memory.popitem(last=False)
+
+    def evict(self):
+        files = []
+        for file in glob.glob(os.path.join(self.path, '*.npz')):
+            try:
+                stat = os.stat(file)
+            except FileNotFoundError:
+                continue # evicted by another process sharing the cache
+            files.append((stat.st_mtime, stat.st_size, file))
+        totalBytes = sum(size for _, size, _ in files)
+        for _, size, file in sorted(files):
+            if totalBytes <= self.maxBytes:
+                break
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            totalBytes -= size
+
+    def clear(self):
+        self.memory.clear()
+        if self.path is not None:
+            for file in glob.glob(os.path.join(self.path, '*.npz')):
+                os.remove(file)
+
+    def getFile(self, key):
+        return os.path.join(self.path, f'{key}.npz')
+
+
+#%% Keys
+
+def getControlKey(cellMask, nPoints, radii, otherData=None, seed=None, nControls=None, **options):
+    h = hashlib.sha256()
+    h.update(f'v{CONTROL_VERSION};n={nPoints};seed={seed};nControls={nControls}'.encode())
+    h.update(hashMask(cellMask).encode())
+    h.update(np.ascontiguousarray(radii, dtype=float).tobytes())
+    h.update(fingerprintPoints(otherData).encode())
+    for name in sorted(options):
+        h.update(f';{name}={options[name]}'.encode())
+    return h.hexdigest()
+
+def getHistogramKey(pointSets, radii):
+    # Key of the cumulative pair distance histograms between the given point sets (data, not random controls)
+    h = hashlib.sha256()
+    h.update(f'histogram;v{CONTROL_VERSION}'.encode())
+    h.update(np.ascontiguousarray(radii, dtype=float).tobytes())
+    for data in pointSets:
+        h.update(fingerprintPoints(data).encode())
+    return h.hexdigest()
+
+def hashMask(cellMask):
+    # Hash of the runs of foreground pixels, so dense and sparse masks of the same pixels share controls
+    h = hashlib.sha256()
+    h.update(f'{tuple(cellMask.shape)};{float(cellMask.pixelsize)!r};{tuple(np.asarray(cellMask.origin, dtype=float))}'.encode())
+    for values in cellMask.getRuns():
+        h.update(np.ascontiguousarray(values, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+def fingerprintPoints(data):
+    if data is None:
+        return 'none'
+    points = cnt.getPoints(data) # coordinates of arrays, KDTrees and CellLists
+    h = hashlib.sha256()
+    h.update(f'{points.shape}'.encode())
+    h.update(points.tobytes())
+    return h.hexdigest()
+
+
+#%% Spatial index cache
+
+INDEX_VERSION = 1 # increase whenever the stored coordinates or indices change
+
+class SpatialIndexCache:
+    # Coordinates (memory-mapped .npy) and pickled KDTrees of localization files, stored next to the data.
+    # Entries are invalidated when the source file (path, size, modification time, optionally content) or the pixel size change.
+    def __init__(self, path, hashContent=False):
+        self.path = path
+        self.hashContent = hashContent # also compare a hash of the file content, slower but independent of modification times
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def loadPoints(self, sourceFile, pixelsize, dtype):
+        fingerprint = self.getFingerprint(sourceFile, pixelsize, dtype)
+        name = self.getName(sourceFile, dtype)
+        try:
+            with open(os.path.join(self.path, f'{name}.json')) as f:
+                if json.load(f) != fingerprint:
+                    return None
+            return np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    def savePoints(self, sourceFile, pixelsize, dtype, points):
+        fingerprint = self.getFingerprint(sourceFile, pixelsize, dtype)
+        name = self.getName(sourceFile, dtype)
+        writeAtomic(os.path.join(self.path, f'{name}.npy'), lambda f: np.save(f, np.ascontiguousarray(points)))
+        writeAtomic(os.path.join(self.path, f'{name}.json'), lambda f: f.write(json.dumps(fingerprint).encode()))
+
+    def loadTree(self, sourceFile, pixelsize, dtype):
+        fingerprint = self.getTreeFingerprint(sourceFile, pixelsize, dtype)
+        try:
+            with open(os.path.join(self.path, f'{self.getName(sourceFile, dtype)}.kdtree.pkl'), 'rb') as f:
+                storedFingerprint, tree = pickle.load(f) # restores the tree structure without rebuilding
+        except Exception:
+            # Missing, partial or incompatible pickle (e.g. of another scipy version), the tree is rebuilt
+            return None
+        return tree if storedFingerprint == fingerprint else None
+
+    def saveTree(self, sourceFile, pixelsize, dtype, tree):
+        fingerprint = self.getTreeFingerprint(sourceFile, pixelsize, dtype)
+        file = os.path.join(self.path, f'{self.getName(sourceFile, dtype)}.kdtree.pkl')
+        writeAtomic(file, lambda f: pickle.dump((fingerprint, tree), f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def getTreeFingerprint(self, sourceFile, pixelsize, dtype):
+        # Pickled trees are only valid for the scipy version that wrote them
+        return dict(self.getFingerprint(sourceFile, pixelsize, dtype), scipy=scipy.__version__)
+
+    def getFingerprint(self, sourceFile, pixelsize, dtype):
+        stat = os.stat(sourceFile)
+        fingerprint = {'version': INDEX_VERSION, 'source': os.path.abspath(sourceFile), 'size': stat.st_size,
+                       'mtime': stat.st_mtime_ns, 'pixelsize': float(pixelsize), 'dtype': np.dtype(dtype).str}
+        if self.hashContent:
+            fingerprint['sha256'] = hashFile(sourceFile)
+        return fingerprint
+
+    def getName(self, sourceFile, dtype):
+        return f'{os.path.splitext(os.path.basename(sourceFile))[0]}_{np.dtype(dtype).name}'
+
+def getIndexCachePath(dataPath):
+    return os.path.join(dataPath, '.spatialindex')
+
+def hashFile(file, blockSize=2**20):
+    h = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def writeAtomic(file, write):
+    tmpfile = f'{file}.{os.getpid()}.tmp'
+    with open(tmpfile, 'wb') as f:
+        write(f)
+    os.replace(tmpfile, file)
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Feb 19 16:32:40 2023
+
+@author: Magdalena Schneider, Janelia Research Campus
+
+Labeled pair counting: cumulative neighbor counts between all labeled subsets of a point cloud
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.spatial import KDTree
+import traceModule as tr
+
+
+#%% Backends
+
+class KDTreeBackend:
+    # Neighbor search with scipy's KDTree
+    name = 'kdtree'
+    
+    def buildIndex(self, data, rmax=None):
+        if isinstance(data, KDTree):
+            return data
+        return KDTree(getPoints(data))
+    
+    @tr.traced('counting.kdtree')
+    def countNeighbors(self, data, otherData, radii, nThreads=1):
+        tree = self.buildIndex(data)
+        otherTree = tree if otherData is None else self.buildIndex(otherData)
+        nThreads = getNumberThreads(nThreads)
+        if nThreads == 1:
+            counts = tree.count_neighbors(otherTree, radii)
+        else:
+            # Spatial blocks of the query points are counted against the full tree on separate threads, the sum is exact
+            countBlock = lambda block: KDTree(tree.data[block]).count_neighbors(otherTree, radii)
+            with ThreadPoolExecutor(max_workers=nThreads) as pool:
+                counts = sum(pool.map(countBlock, getSpatialBlocks(tree.data, nThreads)))
+        return counts - tree.n if otherData is None else counts
+    
+    def iterPairs(self, points, index, rmax, chunkSize=2**16, pointIds=None):
+        # Yields pairs (i, j, squared distance) with |points[i] - index.data[j]| <= rmax.
+        # With pointIds (indices of points in the index), each pair of indexed points is yielded once, with pointIds[i] < j.
+        for start in range(0, len(points), chunkSize):
+            pairs = KDTree(points[start:start+chunkSize]).sparse_distance_matrix(index, rmax, output_type='ndarray')
+            i = pairs['i'].astype(np.int64) + start
+            j = pairs['j'].astype(np.int64)
+            if pointIds is not None:
+                keep = pointIds[i] < j
+                i, j = i[keep], j[keep]
+            yield i, j, ((points[i] - index.data[j])**2).sum(axis=1)
+
+
+class CellList:
+    # Uniform grid of square cells with points sorted by cell, neighbors within cellSize are in the 3x3 adjacent cells
+    def __init__(self, data, cellSize):
+        self.data = getPoints(data)
+        self.n = len(self.data)
+        self.cellSize = float(cellSize)
+        self.origin = self.data.min(axis=0) if self.n else np.zeros(2)
+        cells = self.getCells(self.data)
+        self.shape = cells.max(axis=0) + 1 if self.n else np.ones(2, dtype=np.int64)
+        cellIds = cells[:, 0] * self.shape[1] + cells[:, 1]
+        self.order = np.argsort(cellIds, kind='stable')
+        self.sortedIds = cellIds[self.order]
+        self.sortedData = self.data[self.order]
+    
+    def getCells(self, points):
+        return np.floor((points - self.origin) / self.cellSize).astype(np.int64)
+
+
+class CellListBackend:
+    # Neighbor search with a uniform grid, suited for many points and small maximum radii
+    name = 'celllist'
+    
+    def buildIndex(self, data, rmax=None):
+        if isinstance(data, CellList) and ((rmax is None) or (data.cellSize >= rmax)):
+            return data
+        assert (rmax is not None) and (rmax > 0), "Cell list requires a positive maximum radius"
+        return CellList(data, cellSize=rmax)
+    
+    def countNeighbors(self, data, otherData, radii, nThreads=1):
+        labels = np.zeros(getNumberPoints(data), dtype=np.int64)
+        if otherData is None:
+            counts = countLabeledPairs(data, labels, radii, nLabels=1, backend=self, nThreads=nThreads)
+        else:
+            counts = countLabeledPairs(data, labels, radii, nLabels=1, otherPoints=otherData, nOtherLabels=1, backend=self, nThreads=nThreads)
+        return counts[0, 0]
+    
+    def iterPairs(self, points, index, rmax, chunkSize=2**16, pointIds=None):
+        # Yields candidate pairs (i, j, squared distance) for all j in the 3x3 cells around points[i], which includes all pairs within rmax.
+        # With pointIds (indices of points in the index), each pair of indexed points is yielded once: only half of the adjacent
+        # cells are searched, and pairs in the same cell with pointIds[i] < j.
+        stencil = HALF_STENCIL if pointIds is not None else FULL_STENCIL
+        cells = index.getCells(points)
+        queryOrder = np.argsort(cells[:, 0] * index.shape[1] + cells[:, 1], kind='stable') # process query points cell by cell
+        for start in range(0, len(points), chunkSize):
+            chunkIndex = queryOrder[start:start+chunkSize]
+            chunk = points[chunkIndex]
+            chunkCells = cells[chunkIndex]
+            for offset in stencil:
+                neighborCells = chunkCells + offset
+                inGrid = np.all((neighborCells >= 0) & (neighborCells < index.shape), axis=1)
+                query = np.flatnonzero(inGrid)
+                neighborIds = neighborCells[query, 0] * index.shape[1] + neighborCells[query, 1]
+                first = np.searchsorted(index.sortedIds, neighborIds, side='left')
+                nInCell = np.searchsorted(index.sortedIds, neighborIds, side='right') - first
+                # Expand to all (query point, point in neighbor cell) pairs
+                i = np.repeat(query, nInCell)
+                segmentStart = np.repeat(np.cumsum(nInCell) - nInCell, nInCell)
+                sortedJ = np.repeat(first, nInCell) + np.arange(len(i)) - segmentStart
+                i, j = chunkIndex[i], index.order[sortedJ]
+                if (pointIds is not None) and (offset == (0, 0)):
+                    keep = pointIds[i] < j
+                    i, j, sortedJ = i[keep], j[keep], sortedJ[keep]
+                d2 = ((points[i] - index.sortedData[sortedJ])**2).sum(axis=1)
+                yield i, j, d2
+
+
+FULL_STENCIL = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+HALF_STENCIL = [(0, 0), (0, 1), (1, -1), (1, 0), (1, 1)] # together with the opposite offsets, all adjacent cells
+
+BACKENDS = {'kdtree': KDTreeBackend(), 'celllist': CellListBackend()}
+
+def getBackend(backend='auto', nPoints=None, rmax=None, extent=None):
+    if backend == 'auto':
+        backend = selectBackend(nPoints, rmax, extent)
+    if isinstance(backend, str):
+        if backend not in BACKENDS:
+            raise ValueError(f'Invalid backend, use one of {list(BACKENDS)} or "auto".')
+        return BACKENDS[backend]
+    return backend
+
+def selectBackend(nPoints, rmax, extent=None, maxCandidates=32):
+    # The cell list compares each point with all points in the 3x3 adjacent cells of size rmax. It is faster than the
+    # KDTree as long as the expected number of these candidates per point is small.
+    if (not extent) or (not rmax) or (nPoints is None):
+        return 'kdtree'
+    nCandidates = 9 * nPoints * (rmax / extent)**2
+    return 'celllist' if nCandidates <= maxCandidates else 'kdtree'
+
+
+#%% Labeled pair counting
+
+@tr.traced('counting.labeledPairs')
+def countLabeledPairs(points, labels, radii, nLabels=None, otherPoints=None, otherLabels=None, nOtherLabels=None,
+                      chunkSize=2**16, backend='auto', nThreads=1):
+    # Returns counts[a, b, i] = number of pairs (p, q) with label(p)=a, label(q)=b and |p-q| <= radii[i].
+    # Without otherPoints, pairs within points are counted (ordered pairs, each point excluded with itself),
+    # i.e. counts[a, a] equals tree_a.count_neighbors(tree_a, radii) - n_a and counts[a, b] equals tree_a.count_neighbors(tree_b, radii).
+    # otherPoints can also be a prebuilt index (KDTree or CellList) of the chosen backend.
+    # With nThreads > 1, spatial blocks of points are counted on a thread pool (None for all cores).
+    selfPairs = otherPoints is None
+    otherIndex = None if selfPairs else otherPoints
+    points = getPoints(points)
+    labels = np.asarray(labels, dtype=np.int64)
+    radii = np.asarray(radii, dtype=float)
+    if nLabels is None:
+        nLabels = int(labels.max()) + 1 if len(labels) else 0
+
+    if selfPairs:
+        otherPoints, otherLabels, nOtherLabels = points, labels, nLabels
+    else:
+        otherPoints = getPoints(otherPoints)
+        if otherLabels is None:
+            otherLabels = np.zeros(len(otherPoints), dtype=np.int64)
+        otherLabels = np.asarray(otherLabels, dtype=np.int64)
+        if nOtherLabels is None:
+            nOtherLabels = int(otherLabels.max()) + 1 if len(otherLabels) else 0
+
+    nRadii = len(radii)
+    counts = np.zeros(nLabels * nOtherLabels * nRadii, dtype=np.int64)
+    if (len(points) == 0) or (len(otherPoints) == 0) or (nRadii == 0):
+        return counts.reshape((nLabels, nOtherLabels, nRadii))
+
+    rmax = radii.max()
+    backend = getBackend(backend, len(otherPoints), rmax, getExtent(otherPoints)) # candidates per point depend on the density of otherPoints
+    otherIndex = backend.buildIndex(otherPoints if otherIndex is None else otherIndex, rmax)
+    
+    def countBlock(block):
+        # Pair counts per radius bin of the points in block (indices into points, None for all)
+        blockCounts = np.zeros(len(counts), dtype=np.int64)
+        blockPoints = points if block is None else points[block]
+        # Without otherPoints, each unordered pair is counted once and both orders are added after counting
+        pointIds = (np.arange(len(points)) if block is None else block) if selfPairs else None
+        for i, j, d2 in backend.iterPairs(blockPoints, otherIndex, rmax, chunkSize, pointIds=pointIds):
+            tr.count(f'counting.candidatePairs.{backend.name}', len(i))
+            if block is not None:
+                i = block[i]
+            # Compare squared distances, as count_neighbors does
+            radiusBin = np.searchsorted(radii**2, d2, side='left')
+            valid = radiusBin < nRadii
+            flatIndex = (labels[i[valid]]*nOtherLabels + otherLabels[j[valid]]) * nRadii + radiusBin[valid]
+            blockCounts += np.bincount(flatIndex, minlength=len(counts))
+        return blockCounts
+    
+    nThreads = getNumberThreads(nThreads)
+    if nThreads == 1:
+        counts = countBlock(None)
+    else:
+        with ThreadPoolExecutor(max_workers=nThreads) as pool:
+            counts = sum(pool.map(countBlock, getSpatialBlocks(points, nThreads)))
+
+    counts = counts.reshape((nLabels, nOtherLabels, nRadii))
+    if selfPairs:
+        counts = counts + counts.transpose((1, 0, 2))
+    # Pair counts per radius bin to cumulative counts
+    return np.cumsum(counts, axis=2)
+
+def countPairMatrix(pointSets, radii, chunkSize=2**16, backend='auto', nThreads=1):
+    # Cumulative neighbor counts between all pairs of point sets in a single traversal, shape (nSets, nSets, nRadii)
+    pointSets = [getPoints(data) for data in pointSets]
+    points = np.vstack(pointSets)
+    labels = np.repeat(np.arange(len(pointSets)), [len(data) for data in pointSets])
+    return countLabeledPairs(points, labels, radii, nLabels=len(pointSets), chunkSize=chunkSize, backend=backend, nThreads=nThreads)
+
+def countControlBatch(controlPoints, radii, otherPoints=None, chunkSize=2**16, backend='auto', nQuery=None):
+    # Cumulative neighbor counts for a batch of controls (sequence of point arrays or array of shape (nControls, nPoints, 2)),
+    # returns shape (nControls, nRadii). With nQuery, only the neighbors of the first nQuery points of each control are counted.
+    controlPoints = [getPoints(points) for points in controlPoints]
+    nControls = len(controlPoints)
+    nPoints = np.array([len(points) for points in controlPoints], dtype=np.int64)
+    labels = np.repeat(np.arange(nControls), nPoints)
+    points = np.vstack(controlPoints) if nControls else np.zeros((0, 2))
+    nQueries = nPoints if nQuery is None else np.minimum(nPoints, nQuery)
+    query = slice(None)
+    if (nQuery is not None) and nControls:
+        query = np.concatenate([start + np.arange(n) for start, n in zip(np.cumsum(nPoints) - nPoints, nQueries)])
+    if otherPoints is None:
+        # Select the backend for a single control, before shifting
+        extent = getExtent(points)
+        backend = getBackend(backend, len(points) // max(nControls, 1), np.max(radii), extent)
+        # Shift controls apart so that pairs between different controls are never within range
+        shift = extent + 2*np.max(radii) + 1
+        points = points.copy()
+        points[:, 0] += shift * labels
+        counts = countLabeledPairs(points[query], labels[query], radii, nLabels=nControls, otherPoints=points,
+                                   nOtherLabels=1, chunkSize=chunkSize, backend=backend)
+        return counts[:, 0] - nQueries[:, None] # remove each point paired with itself
+    counts = countLabeledPairs(points[query], labels[query], radii, nLabels=nControls,
+                               otherPoints=otherPoints, nOtherLabels=1, chunkSize=chunkSize, backend=backend)
+    return counts[:, 0]
+
+
+#%% Pair distance histograms
+
+def getHistogramRadii(radii, binWidth=None, rmax=None):
+    # Fine grid binWidth, 2*binWidth, ... up to rmax (default: largest radius) where cumulative counts are stored once.
+    # Without binWidth, counts are taken at radii directly.
+    if binWidth is None:
+        return np.asarray(radii, dtype=float)
+    if rmax is None:
+        rmax = np.max(radii)
+    nBins = int(np.ceil(rmax / binWidth - 1e-9))
+    return binWidth * np.arange(1, nBins+1, dtype=float)
+
+def resampleCumulative(values, histogramRadii, radii):
+    # Cumulative values (counts or K, last axis along histogramRadii) at other radii up to the largest histogram radius.
+    # Linear between the histogram radii (zero at radius 0), exact for radii on the histogram grid.
+    radii = np.asarray(radii, dtype=float)
+    if np.max(radii) > histogramRadii[-1] * (1 + 1e-12):
+        raise ValueError(f'Radii up to {np.max(radii):.4g} exceed the pair distance histogram up to {histogramRadii[-1]:.4g}.')
+    values = np.asarray(values, dtype=float)
+    grid = np.concatenate(([0.], histogramRadii))
+    values = np.concatenate((np.zeros(values.shape[:-1] + (1,)), values), axis=-1)
+    upper = np.clip(np.searchsorted(grid, radii, side='left'), 1, len(grid)-1)
+    lower = upper - 1
+    weight = (radii - grid[lower]) / (grid[upper] - grid[lower])
+    return values[..., lower] * (1 - weight) + values[..., upper] * weight
+
+
+#%% Incremental index
+
+class IncrementalIndex:
+    # Growing point set stored as a few indexes of decreasing size (logarithmic method): a new batch is merged with the
+    # last indexes as long as they are not larger, so each point is indexed again only O(log n) times
+    def __init__(self, backend='kdtree', rmax=None):
+        self.backend = getBackend(backend)
+        self.rmax = rmax # required by the cell list backend
+        self.indexes = []
+    
+    @property
+    def n(self):
+        return sum(index.n for index in self.indexes)
+    
+    def add(self, data):
+        points = getPoints(data)
+        while self.indexes and (self.indexes[-1].n <= len(points)):
+            points = np.vstack((self.indexes.pop().data, points))
+        if len(points):
+            self.indexes.append(self.backend.buildIndex(points, self.rmax))
+    
+    def countNeighbors(self, data, radii, nThreads=1):
+        # Cumulative neighbor counts of data against all indexed points
+        counts = np.zeros(len(radii), dtype=np.int64)
+        for index in self.indexes:
+            counts += self.backend.countNeighbors(data, index, radii, nThreads=nThreads)
+        return counts
+    
+    def getPoints(self):
+        return np.vstack([index.data for index in self.indexes]) if self.indexes else np.zeros((0, 2))
+
+
+#%% Helper functions
+
+def getPoints(data):
+    if isinstance(data, (KDTree, CellList)):
+        data = data.data
+    return np.ascontiguousarray(data, dtype=float)
+
+def getNumberPoints(data):
+    if isinstance(data, (KDTree, CellList)):
+        return data.n
+    return len(data)
+
+def getExtent(points):
+    if len(points) == 0:
+        return 0
+    return np.max(np.ptp(points, axis=0))
+
+def getNumberThreads(nThreads):
+    return os.cpu_count() if nThreads is None else max(int(nThreads), 1)
+
+def getSpatialBlocks(points, nThreads, blocksPerThread=4):
+    # Indices of points split into compact blocks of similar size: points are ordered along rows of a coarse grid
+    # (alternating direction), then split into consecutive blocks
+    if len(points) == 0:
+        return [np.arange(0)]
+    nBlocks = min(nThreads * blocksPerThread, len(points))
+    nCells = int(np.ceil(np.sqrt(nBlocks)))
+    origin = points.min(axis=0)
+    cellSize = max(getExtent(points), 1e-12) / nCells
+    cells = np.minimum(np.floor((points - origin) / cellSize).astype(np.int64), nCells-1)
+    cols = np.where(cells[:, 1] % 2 == 0, cells[:, 0], nCells - 1 - cells[:, 0])
+    order = np.lexsort((points[:, 0], cols, cells[:, 1]))
+    return [block for block in np.array_split(order, nBlocks) if len(block)]
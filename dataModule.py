@@ -6,24 +6,26 @@ Created on Thu Nov 10 22:22:05 2022
 """
 
 import os
-from tqdm import tqdm
-import pandas as pd
-import yaml
-import h5py
+import numpy as np
 from scipy.spatial import KDTree
-import matplotlib.pyplot as plt
+import traceModule as tr
 
 class LocalizationData:
-    def __init__(self, path, filename, fileIDs):
+    def __init__(self, path, filename, fileIDs, dtype=np.float64, lazy=True, indexCache=None):
         self.path = path
         self.filename = filename
         self.fileIDs = fileIDs
         self.nReceptors = len(fileIDs)
-        self.nPixels = (512, 512)
+        self.cameraPixels = (512, 512) # minimum field of view in pixels (x, y)
+        self.dtype = dtype # float32 halves the memory of the coordinates
         self.pixelsize = self.loadPixelSize()
-        self.data = self.loadData() # list of data
-        self.forest = self.buildForest() # list of all trees
-        self.allData = self.loadAllData() # multi-file
+        self.indexCache = indexCache # SpatialIndexCache for coordinates and trees, None to always read and build
+        self.data = LazyList(self.loadReceptor, self.nReceptors) # list of data, each receptor is loaded on first access
+        self.forest = LazyList(self.buildTree, self.nReceptors) # list of all trees, built on first access
+        self._allData = None
+        if not lazy:
+            self.loadData()
+            self.buildForest()
         
         
     def loadPixelSize(self):
@@ -32,51 +34,125 @@ class LocalizationData:
         pixelsize = fileinfo["Pixelsize"] # given in nm
         return pixelsize
     
-    def loadAllData(self):
-        filename = f'{self.filename}_multi.hdf5'
-        file = os.path.join(self.path, filename)
-        df = pd.read_hdf(file, key='locs')
-        allData = df[['x','y']] # load xy-coordinates of locs (input is in px)
-        allData *= self.pixelsize
-        return allData
+    @property
+    def nPixels(self):
+        # Field of view in pixels (x, y), the camera size enlarged to cover all localizations
+        extent = np.ceil(np.max(self.allData, axis=0) / self.pixelsize).astype(int)
+        return (max(int(extent[0]), self.cameraPixels[0]), max(int(extent[1]), self.cameraPixels[1]))
+    
+    @property
+    def allData(self):
+        # All receptors combined, instead of reading the multi-file a second time
+        if self._allData is None:
+            self._allData = np.concatenate([self.data[k] for k in range(self.nReceptors)])
+        return self._allData
+    
+    def loadReceptor(self, k):
+        file = self.getReceptorFile(k)
+        with tr.span('load.receptor', receptor=self.fileIDs[k]):
+            if self.indexCache is not None:
+                points = self.indexCache.loadPoints(file, self.pixelsize, self.dtype)
+                if points is not None:
+                    tr.count('load.indexCacheHits')
+                    tr.count('load.points', len(points))
+                    return points
+            points = loadCoordinates(file, self.pixelsize, self.dtype)
+            tr.count('load.points', len(points))
+            if self.indexCache is not None:
+                self.indexCache.savePoints(file, self.pixelsize, self.dtype, points)
+        return points
+    
+    def getReceptorFile(self, k):
+        thisFilename = f'{self.filename}_Receptor_{self.fileIDs[k]}.hdf5'
+        return os.path.join(self.path, thisFilename)
         
     def loadData(self):
+        from tqdm import tqdm
         print('Loading data...')
-        data = []
-        for k in tqdm(self.fileIDs):
-            thisFilename = f'{self.filename}_Receptor_{k}.hdf5'
-            file = os.path.join(self.path, thisFilename)
-            df = pd.read_hdf(file, key='locs')
-            locs = df[['x','y']] # load xy-coordinates of locs (input is in px)
-            locs *= self.pixelsize
-            data.append(locs)
-        return data
+        return [self.data[k] for k in tqdm(range(self.nReceptors))]
+    
+    def buildTree(self, k):
+        data = self.data[k]
+        with tr.span('index.buildTree', receptor=self.fileIDs[k], nPoints=len(data)):
+            if self.indexCache is None:
+                return KDTree(data)
+            file = self.getReceptorFile(k)
+            tree = self.indexCache.loadTree(file, self.pixelsize, self.dtype)
+            if tree is None:
+                tree = KDTree(data)
+                self.indexCache.saveTree(file, self.pixelsize, self.dtype, tree)
+            else:
+                tr.count('index.cacheHits')
+        return tree
             
     def buildForest(self):
+        from tqdm import tqdm
         print('Building forest...')
-        forest = [] # list of all trees
-        for k in tqdm(range(self.nReceptors)):
-            tree = KDTree(self.data[k])
-            forest.append(tree)
-        return forest
+        return [self.forest[k] for k in tqdm(range(self.nReceptors))]
             
     def plot(self, receptor='all', title=None):
+        import matplotlib.pyplot as plt
         plt.figure()
         if receptor=='all':
-            plt.plot(self.allData.x, self.allData.y, '.', markersize=1)
+            plt.plot(self.allData[:,0], self.allData[:,1], '.', markersize=1)
         elif (type(receptor) == int) and (receptor >= 1) and (receptor <= self.nReceptors):
-            plt.plot(self.data[receptor-1].x, self.data[receptor-1].y, '.', markersize=1)
+            plt.plot(self.data[receptor-1][:,0], self.data[receptor-1][:,1], '.', markersize=1)
         else:
             raise ValueError('Invalid receptor id.')
-        plt.xlim(0,self.nPixels[0]*self.pixelsize)
-        plt.ylim(0,self.nPixels[0]*self.pixelsize)
+        nPixels = self.nPixels
+        plt.xlim(0,nPixels[0]*self.pixelsize)
+        plt.ylim(0,nPixels[1]*self.pixelsize)
         axes = plt.gca()
         axes.set_aspect('equal')
         if title is not None:
             axes.set_title(title)
             
 
+class LazyList:
+    # Read-only list whose items are created by load(k) on first access
+    def __init__(self, load, length):
+        self.load = load
+        self.items = [None] * length
+        
+    def __len__(self):
+        return len(self.items)
+    
+    def __getitem__(self, k):
+        if self.items[k] is None:
+            self.items[k] = self.load(range(len(self.items))[k])
+        return self.items[k]
+    
+    def __iter__(self):
+        return (self[k] for k in range(len(self)))
+    
+    def isLoaded(self, k):
+        return self.items[k] is not None
+
+
+def loadCoordinates(file, pixelsize, dtype=np.float64):
+    # Read only the xy-coordinates of the locs (input is in px) into a contiguous (n, 2) array in nm
+    import h5py
+    with h5py.File(file, 'r') as f:
+        locs = f['locs']
+        if isinstance(locs, h5py.Dataset) and (locs.dtype.names is not None):
+            xy = locs.fields(['x', 'y'])[()]
+            x, y = xy['x'], xy['y']
+        else:
+            x = y = None
+    if x is None:
+        # Table written by pandas
+        import pandas as pd
+        df = pd.read_hdf(file, key='locs', columns=['x', 'y'])
+        x, y = df['x'].to_numpy(), df['y'].to_numpy()
+    tr.count('load.bytesRead', x.nbytes + y.nbytes)
+    points = np.empty((len(x), 2), dtype=dtype)
+    points[:,0] = x
+    points[:,1] = y
+    points *= pixelsize
+    return points
+
 def loadYaml(path, filename):
+    import yaml
     filepath = os.path.join(path, filename)
     file = open(filepath)  
     generator = yaml.load_all(file, Loader=yaml.FullLoader)
@@ -85,8 +161,8 @@ def loadYaml(path, filename):
         fileinfo.update(d)
     return fileinfo
 
-def loadLocalizationData(path, filename, nReceptors):
-    locData = LocalizationData(path, filename, nReceptors)
+def loadLocalizationData(path, filename, nReceptors, **kwargs):
+    locData = LocalizationData(path, filename, nReceptors, **kwargs)
     return locData
 
 
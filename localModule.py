@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Apr  1 14:36:52 2023
+
+@author: Magdalena Schneider, Janelia Research Campus
+
+Local Ripley's functions per localization, computed in chunks and streamed to disk
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import countingModule as cnt
+import traceModule as tr
+
+LOCAL_CURVES = ('L', 'expectedL', 'z')
+
+
+def computeLocalRipleys(data, radii, cellMask, otherData=None, output=None, chunkSize=2**16, nWorkers=None, backend='auto', dtype=np.float32):
+    # Local L(r) of every localization of data (neighbors from otherData for cross Ripley's), its expectation under
+    # CSR in the mask and the z-score of the neighbor count, each of shape (nPoints, nRadii).
+    # output: h5py group the curves are streamed to chunk by chunk, None to return them as arrays.
+    # Chunks are counted on nWorkers threads, only a few chunks are in memory at the same time.
+    from tqdm import tqdm
+    radii = np.asarray(radii, dtype=float)
+    points = cnt.getPoints(data)
+    nPoints = len(points)
+    selfPairs = otherData is None
+    nOther = nPoints if selfPairs else cnt.getNumberPoints(otherData)
+    otherPoints = points if selfPairs else cnt.getPoints(otherData)
+    backend = cnt.getBackend(backend, nOther, radii.max(), cnt.getExtent(otherPoints))
+    index = backend.buildIndex(data if selfPairs else otherData, radii.max())
+    coverage = PixelCoverage(cellMask, radii, points)
+    nNeighbors = nOther - 1 if selfPairs else nOther # possible neighbors of each localization
+    density = nOther / cellMask.area
+
+    if output is None:
+        curves = {name: np.zeros((nPoints, len(radii)), dtype=dtype) for name in LOCAL_CURVES}
+    else:
+        chunks = (min(chunkSize, max(nPoints, 1)), len(radii))
+        curves = {name: output.create_dataset(name, shape=(nPoints, len(radii)), dtype=dtype, chunks=chunks) for name in LOCAL_CURVES}
+        output.create_dataset('radii', data=radii)
+        output.attrs['nPoints'] = nPoints
+        output.attrs['nOther'] = nOther
+
+    def countChunk(start):
+        chunk = points[start:start+chunkSize]
+        counts = countPointNeighbors(chunk, index, radii, backend, offset=start if selfPairs else None)
+        pairProbability = coverage.get(chunk) / cellMask.area # probability of a random localization within r
+        expectedCounts = nNeighbors * pairProbability
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = (counts - expectedCounts) / np.sqrt(expectedCounts * (1 - pairProbability))
+        return start, {'L': np.sqrt(counts / density / np.pi), 'expectedL': np.sqrt(expectedCounts / density / np.pi), 'z': z}
+
+    if nWorkers is None:
+        nWorkers = os.cpu_count()
+    with tr.span('local.ripleys', nPoints=nPoints), ThreadPoolExecutor(max_workers=nWorkers) as pool, tqdm(total=nPoints) as progress:
+        pending = deque()
+        for start in range(0, nPoints, chunkSize):
+            pending.append(pool.submit(countChunk, start))
+            if len(pending) > 2*nWorkers: # bounded number of finished chunks waiting to be written
+                writeChunk(curves, *pending.popleft().result(), progress)
+        while pending:
+            writeChunk(curves, *pending.popleft().result(), progress)
+    return curves if output is None else output
+
+def writeChunk(curves, start, chunkCurves, progress):
+    for name, values in chunkCurves.items():
+        curves[name][start:start+len(values)] = values
+    progress.update(len(values))
+
+def countPointNeighbors(points, index, radii, backend, offset=None):
+    # counts[i, r] = number of indexed points within radii[r] of points[i], in a single traversal.
+    # With offset, points are index.data[offset:offset+len(points)] and are not counted as their own neighbors.
+    nRadii = len(radii)
+    counts = np.zeros(len(points) * nRadii, dtype=np.int64)
+    for i, j, d2 in backend.iterPairs(points, index, radii.max(), chunkSize=len(points)):
+        if offset is not None:
+            keep = (i + offset != j)
+            i, d2 = i[keep], d2[keep]
+        radiusBin = np.searchsorted(radii**2, d2, side='left')
+        valid = radiusBin < nRadii
+        counts += np.bincount(i[valid] * nRadii + radiusBin[valid], minlength=len(counts))
+    tr.count('local.points', len(points))
+    return np.cumsum(counts.reshape((len(points), nRadii)), axis=1)
+
+
+class PixelCoverage:
+    # Masked area within each radius around the pixels of the localizations, computed once per occupied pixel
+    def __init__(self, cellMask, radii, points):
+        self.cellMask = cellMask
+        rows, cols = self.getPixels(points)
+        self.pixels = np.unique(rows * cellMask.shape[1] + cols)
+        self.coverage = cellMask.getCoverage(self.pixels, radii) # shape (nPixels, nRadii)
+
+    def getPixels(self, points):
+        rows, cols, __ = self.cellMask.getPixels(points)
+        # Localizations on the image border belong to the border pixel
+        return np.clip(rows, 0, self.cellMask.shape[0]-1), np.clip(cols, 0, self.cellMask.shape[1]-1)
+
+    def get(self, points):
+        rows, cols = self.getPixels(points)
+        return self.coverage[np.searchsorted(self.pixels, rows * self.cellMask.shape[1] + cols)]
+
+
+#%% Helper functions
+
+def getLocalFile(path, filename):
+    return os.path.join(path, 'results', f'{filename}_localRipleys.h5')
@@ -7,15 +7,20 @@ Created on Sun Nov  6 22:11:55 2022
 
 import os
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.ndimage import zoom, gaussian_filter
+import traceModule as tr
+
+DEFAULT_SHAPE = (512, 512) # camera size in pixels (rows, columns), created masks are enlarged to cover all localizations
 
 class Mask:
-    def __init__(self, mask, pixelsize):
+    def __init__(self, mask, pixelsize, origin=(0, 0)):
         self.mask = mask
         self.shape = mask.shape
         self.pixelsize = pixelsize
+        self.origin = np.asarray(origin, dtype=float) # (x, y) of the image corner in nm, nonzero for tiles
         self.area = self.getArea()
+        self.foregroundPixels = self.getForegroundPixels() # (x, y) of all mask pixels, used for sampling
+        self.covariogram = None # set covariance, computed on first use
+        self.csrMoments = {} # CSR pair moments per radii
         
     def getArea(self):
         maskArea = self.getAreaInPixel() * (self.pixelsize**2)
@@ -24,12 +29,63 @@ class Mask:
     def getAreaInPixel(self):
         return self.mask.sum()
     
+    def getForegroundPixels(self):
+        rows, cols = np.nonzero(self.mask)
+        return np.column_stack((cols, rows)).astype(float)
+    
+    def getPixelPositions(self, index):
+        # (x, y) in pixels of foreground pixels, numbered in row-major order
+        return self.foregroundPixels[index]
+    
+    def getRuns(self):
+        # Run-length encoding: row, first column and length of each horizontal run of foreground pixels
+        return getRuns(self.mask)
+    
     def getCoveredFraction(self):
         imageArea = (self.shape[0] * self.shape[1])
-        maskFraction = self.mask.sum() / imageArea
+        maskFraction = self.getAreaInPixel() / imageArea
         return maskFraction
     
+    def getExtent(self):
+        # xmin, xmax, ymin, ymax of the image in nm
+        xmin, ymin = self.origin
+        return xmin, xmin + self.shape[1]*self.pixelsize, ymin, ymin + self.shape[0]*self.pixelsize
+    
+    def getPixels(self, points):
+        # Row and column of the pixel of each point, and whether it is within the image
+        pixels = np.floor((np.asarray(points)[:, :2] - self.origin) / self.pixelsize).astype(np.int64)
+        rows, cols = pixels[:, 1], pixels[:, 0]
+        inImage = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        return rows, cols, inImage
+    
+    def contains(self, points):
+        rows, cols, inImage = self.getPixels(points)
+        inMask = np.zeros(len(rows), dtype=bool)
+        inMask[inImage] = self.mask[rows[inImage], cols[inImage]]
+        return inMask
+    
+    def getTiles(self, tileShape):
+        # Split the image into tiles of at most tileShape pixels (rows, columns). Every tile with foreground is
+        # returned as a SparseMask at its position, so it can be analyzed independently.
+        rows, starts, lengths = self.getRuns()
+        ends = starts + lengths
+        tiles = []
+        for rowStart in range(0, self.shape[0], tileShape[0]):
+            rowEnd = min(rowStart + tileShape[0], self.shape[0])
+            for colStart in range(0, self.shape[1], tileShape[1]):
+                colEnd = min(colStart + tileShape[1], self.shape[1])
+                select = (rows >= rowStart) & (rows < rowEnd) & (ends > colStart) & (starts < colEnd)
+                if not select.any():
+                    continue
+                tileStarts = np.maximum(starts[select], colStart)
+                tileEnds = np.minimum(ends[select], colEnd)
+                origin = self.origin + np.array([colStart, rowStart]) * self.pixelsize
+                tiles.append(SparseMask(rows[select] - rowStart, tileStarts - colStart, tileEnds - tileStarts,
+                                        (rowEnd - rowStart, colEnd - colStart), self.pixelsize, origin))
+        return tiles
+    
     def plot(self):
+        import matplotlib.pyplot as plt
         plt.figure()
         plt.imshow(self.mask, origin='lower')
         
@@ -42,28 +98,102 @@ class Mask:
         im = Image.fromarray(mask)
         im.save(f'{maskfile}.tiff')
         
-    def randomPoints(self, nPoints):
-        imageArea = (self.mask.shape[0] * self.mask.shape[1])
-        density = (nPoints / self.getAreaInPixel())
-        nSample = int(density * imageArea) # density points in mask, scale to whole image
-        
-        points = np.random.uniform(0, self.mask.shape[0], size=(nSample,2)) # create points in units of pixels
+    def randomPoints(self, nPoints, rng=None):
+        points = self.randomPointsBatch(1, nPoints, rng=rng)[0]
+        nFactor = 1.0 # exactly nPoints are returned
+        return points, nFactor
+    
+    def randomPointsBatch(self, nControls, nPoints, rng=None):
+        # Draw exactly nPoints uniformly distributed points in the mask for each of nControls controls,
+        # rng can also be a sequence of one random generator per control
+        if rng is None:
+            rng = np.random # fall back to the global random state
+        if isinstance(rng, (list, tuple)):
+            assert (len(rng) == nControls), "One random generator per control required"
+            points = np.zeros((nControls, nPoints, 2))
+            for j, controlRng in enumerate(rng):
+                points[j] = self.randomPointsBatch(1, nPoints, rng=controlRng)[0]
+            return points
         
-        # Reject points outside of mask
-        (steps_x, steps_y) = (1,1)
-        x_ind = (np.floor(points[:,0] / steps_x)).astype(int)
-        y_ind = (np.floor(points[:,1] / steps_y)).astype(int)
-        index = self.mask[y_ind, x_ind].astype(bool)
-        points = points[index,:] # locs in the mask
+        # Pick a random mask pixel for every point, then jitter uniformly within the pixel
+        tr.count('mask.randomPoints', nControls*nPoints)
+        nForeground = self.getAreaInPixel()
+        index = rng.uniform(0, nForeground, size=(nControls, nPoints)).astype(np.intp)
+        np.minimum(index, nForeground-1, out=index)
+        points = self.getPixelPositions(index) + rng.uniform(0, 1, size=(nControls, nPoints, 2)) # in units of pixels
         points *= self.pixelsize
-        nFactor = len(points) / nPoints # factor of actual to desired number of returned points
-        return points, nFactor
+        points += self.origin
+        return points
+    
+    def getCovariogram(self):
+        # Set covariance (overlap area of the mask with its shifted copy) for all integer pixel shifts, in px^2
+        from scipy.signal import fftconvolve
+        if self.covariogram is None:
+            with tr.span('mask.covariogram'):
+                mask = self.mask.astype(float)
+                covariogram = fftconvolve(mask, mask[::-1, ::-1], mode='full')
+                self.covariogram = np.clip(np.round(covariogram), 0, None)
+        return self.covariogram
+    
+    def getCSRMoments(self, radii):
+        # Pair moments of uniformly distributed points in the mask:
+        # pairProbability = P(|X-Y| <= r) for independent X, Y and coverageVariance = Var(|mask within r of X| / area)
+        key = np.asarray(radii, dtype=float).tobytes()
+        if key not in self.csrMoments:
+            self.csrMoments[key] = (self.getPairProbability(radii), self.getCoverageVariance(radii))
+        return self.csrMoments[key]
+    
+    def getPairProbability(self, radii, nAngles=128):
+        # Integrate the set covariance over discs of radius r. The mask is a union of pixels, so the
+        # set covariance for non-integer shifts is exactly the bilinear interpolation of the covariogram.
+        from scipy.ndimage import map_coordinates
+        radii = np.asarray(radii, dtype=float) / self.pixelsize
+        covariogram = self.getCovariogram()
+        center = (np.array(covariogram.shape) - 1) / 2
+        rmax = radii.max()
+        rho = np.linspace(0, rmax, max(256, int(np.ceil(32*rmax))))
+        theta = np.linspace(0, 2*np.pi, nAngles, endpoint=False)
+        rows = center[0] + rho[:, None] * np.sin(theta)
+        cols = center[1] + rho[:, None] * np.cos(theta)
+        setCovariance = map_coordinates(covariogram, [rows.ravel(), cols.ravel()], order=1).reshape(rows.shape)
+        ringIntegral = setCovariance.mean(axis=1) * 2*np.pi * rho
+        discIntegral = np.concatenate(([0], np.cumsum(np.diff(rho) * (ringIntegral[1:] + ringIntegral[:-1]) / 2)))
+        # Interpolate the mean set covariance over the disc, which is smooth in r, instead of the integral itself
+        meanSetCovariance = np.concatenate(([covariogram[tuple(center.astype(int))]], discIntegral[1:] / (np.pi * rho[1:]**2)))
+        areaInPixel = self.getAreaInPixel()
+        return np.interp(radii, rho, meanSetCovariance) * np.pi * radii**2 / areaInPixel**2
+    
+    def getCoverageVariance(self, radii, supersampling=16):
+        # Variance over mask pixels of the masked area within distance r, relative to the mask area.
+        # Evaluated at pixel resolution, so this is approximate for radii below the pixel size.
+        from scipy.signal import fftconvolve
+        radii = np.asarray(radii, dtype=float) / self.pixelsize
+        mask = self.mask.astype(float)
+        inMask = self.mask.astype(bool)
+        areaInPixel = self.getAreaInPixel()
+        coverageVariance = np.zeros(len(radii))
+        for j, r in enumerate(radii):
+            coverage = fftconvolve(mask, getDiscKernel(r, supersampling), mode='same')[inMask] / areaInPixel
+            coverageVariance[j] = coverage.var()
+        return coverageVariance
+    
+    def getCoverage(self, pixels, radii, supersampling=16):
+        # Masked area (nm^2) within each radius around the given pixels (row-major indices), shape (nPixels, nRadii).
+        # Evaluated at pixel resolution like getCoverageVariance.
+        from scipy.signal import fftconvolve
+        mask = self.mask.astype(float)
+        coverage = np.zeros((len(pixels), len(radii)))
+        for j, r in enumerate(np.asarray(radii, dtype=float) / self.pixelsize):
+            coverage[:, j] = fftconvolve(mask, getDiscKernel(r, supersampling), mode='same').ravel()[pixels]
+        return np.clip(coverage, 0, None) * self.pixelsize**2
     
     def plotPoints(self, points, title=None):
+        import matplotlib.pyplot as plt
         plt.figure()
         plt.plot(points[:,0], points[:,1], '.', markersize=1)
-        plt.xlim(0,self.shape[0]*self.pixelsize)
-        plt.ylim(0,self.shape[0]*self.pixelsize)
+        xmin, xmax, ymin, ymax = self.getExtent()
+        plt.xlim(xmin, xmax)
+        plt.ylim(ymin, ymax)
         axes = plt.gca()
         axes.set_aspect('equal')
         if title is not None:
@@ -71,21 +201,146 @@ class Mask:
         plt.xlabel('x')
         plt.ylabel('y')
         
+
+class SparseMask(Mask):
+    # Mask stored as horizontal runs of foreground pixels (row, first column, length). Memory, area, sampling and
+    # membership tests scale with the foreground instead of the image size. Random points are identical to those of
+    # the dense Mask with the same pixels. The dense mask is only built on access, e.g. for the analytic null model.
+    def __init__(self, rows, starts, lengths, shape, pixelsize, origin=(0, 0)):
+        rows, starts, lengths = (np.asarray(values, dtype=np.int64) for values in (rows, starts, lengths))
+        order = np.lexsort((starts, rows))
+        self.rows = rows[order]
+        self.starts = starts[order]
+        self.lengths = lengths[order]
+        self.runEnds = np.cumsum(self.lengths) # number of foreground pixels up to the end of each run
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.pixelsize = pixelsize
+        self.origin = np.asarray(origin, dtype=float)
+        self.area = self.getArea()
+        self.covariogram = None
+        self.csrMoments = {}
+        self._mask = None
+    
+    @property
+    def mask(self):
+        if self._mask is None:
+            mask = np.zeros(self.shape, dtype=bool)
+            mask.flat[self.getFlatIndex(np.arange(self.getAreaInPixel()))] = True
+            self._mask = mask
+        return self._mask
+    
+    @property
+    def foregroundPixels(self):
+        return self.getPixelPositions(np.arange(self.getAreaInPixel()))
+    
+    def getAreaInPixel(self):
+        return int(self.runEnds[-1]) if len(self.runEnds) else 0
+    
+    def getPixelPositions(self, index):
+        run = np.searchsorted(self.runEnds, index, side='right')
+        cols = self.starts[run] + index - (self.runEnds[run] - self.lengths[run])
+        return np.stack((cols, self.rows[run]), axis=-1).astype(float)
+    
+    def getFlatIndex(self, index):
+        run = np.searchsorted(self.runEnds, index, side='right')
+        return self.rows[run] * self.shape[1] + self.starts[run] + index - (self.runEnds[run] - self.lengths[run])
+    
+    def getRuns(self):
+        return self.rows, self.starts, self.lengths
+    
+    def contains(self, points):
+        rows, cols, inImage = self.getPixels(points)
+        if len(self.rows) == 0:
+            return np.zeros(len(rows), dtype=bool)
+        # Last run starting at or before the pixel, in row-major order
+        run = np.searchsorted(self.rows * self.shape[1] + self.starts, rows * self.shape[1] + cols, side='right') - 1
+        inMask = inImage & (run >= 0)
+        run = np.maximum(run, 0)
+        inMask &= (self.rows[run] == rows) & (cols < self.starts[run] + self.lengths[run])
+        return inMask
         
 
+
+def getDiscKernel(radius, supersampling=16):
+    # Area of each pixel covered by a disc of the given radius (in pixels) centered on the central pixel
+    halfSize = int(np.ceil(radius + 0.5))
+    offsets = (np.arange(supersampling) + 0.5) / supersampling - 0.5
+    grid = np.arange(-halfSize, halfSize+1)
+    x = (grid[:, None] + offsets[None, :]).ravel()
+    inside = (x[:, None]**2 + x[None, :]**2) <= radius**2
+    kernel = inside.reshape(len(grid), supersampling, len(grid), supersampling).mean(axis=(1, 3))
+    if kernel.sum() > 0:
+        kernel *= (np.pi * radius**2) / kernel.sum() # exact disc area also for subpixel radii
+    else:
+        kernel[halfSize, halfSize] = np.pi * radius**2
+    return kernel
+
 def loadMask(path, filename, pixelsize):
     maskfile = os.path.join(path, filename)
     maskData = np.load(maskfile)
     mask = Mask(maskData, pixelsize)
     return mask
 
-def createMask(data, pixelsize):
+@tr.traced('mask.create')
+def createMask(data, pixelsize, shape=None, sparse=False):
+    # shape: (rows, columns) in pixels, by default the camera size enlarged to cover all localizations
+    from scipy.ndimage import zoom, gaussian_filter
+    if shape is None:
+        shape = getMaskShape(data, pixelsize)
+    if sparse:
+        return createSparseMask(data, pixelsize, shape)
     binningFactor = 1
-    binEdges = np.arange(0, (512+1), binningFactor) # binning
-    histCounts, xedges, yedges = np.histogram2d(data.x / pixelsize, data.y / pixelsize, bins=[binEdges,binEdges])
+    rowEdges = np.arange(0, (shape[0]+1), binningFactor) # binning
+    colEdges = np.arange(0, (shape[1]+1), binningFactor)
+    histCounts, xedges, yedges = np.histogram2d(data[:,0] / pixelsize, data[:,1] / pixelsize, bins=[colEdges,rowEdges])
     histCounts = np.flipud(np.rot90(histCounts))
     histCounts = gaussian_filter(histCounts, sigma=0.3)
     histCounts = zoom(histCounts, binningFactor, order=0) # upsample to original pixel number
     maskData = (histCounts>0) # create binary mask from histogram
     mask = Mask(maskData, pixelsize)
     return mask
+
+@tr.traced('mask.create')
+def createSparseMask(data, pixelsize, shape=None):
+    # Same pixels as createMask, built from the occupied pixels without a dense histogram
+    if shape is None:
+        shape = getMaskShape(data, pixelsize)
+    x = data[:,0] / pixelsize
+    y = data[:,1] / pixelsize
+    inImage = (x >= 0) & (x <= shape[1]) & (y >= 0) & (y <= shape[0]) # upper image edge belongs to the last pixel, as in histogram2d
+    cols = np.minimum(np.floor(x[inImage]).astype(np.int64), shape[1]-1)
+    rows = np.minimum(np.floor(y[inImage]).astype(np.int64), shape[0]-1)
+    occupied = np.unique(rows * shape[1] + cols)
+    # The Gaussian filter (sigma 0.3 px) of createMask marks the 8 neighbors of every occupied pixel
+    rows, cols = np.divmod(occupied, shape[1])
+    offsets = np.array([-1, 0, 1])
+    rows = (rows[:, None, None] + offsets[None, :, None]).repeat(3, axis=2).ravel()
+    cols = (cols[:, None, None] + offsets[None, None, :]).repeat(3, axis=1).ravel()
+    valid = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    flatIndex = np.unique(rows[valid] * shape[1] + cols[valid])
+    return SparseMask(*getRunsFromIndex(flatIndex, shape[1]), shape, pixelsize)
+
+def getMaskShape(data, pixelsize, minShape=DEFAULT_SHAPE):
+    # (rows, columns) covering all localizations, at least minShape
+    if len(data) == 0:
+        return tuple(minShape)
+    extent = np.ceil(np.max(data[:, :2], axis=0) / pixelsize).astype(int)
+    return (max(int(extent[1]), minShape[0]), max(int(extent[0]), minShape[1]))
+
+def getRuns(mask):
+    # Row, first column and length of all horizontal runs of a boolean mask
+    padded = np.zeros((mask.shape[0], mask.shape[1]+2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    change = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(change == 1)
+    __, ends = np.nonzero(change == -1)
+    return rows, starts, ends - starts
+
+def getRunsFromIndex(flatIndex, nCols):
+    # Runs of the pixels with sorted, unique row-major indices
+    rows, cols = np.divmod(np.asarray(flatIndex, dtype=np.int64), nCols)
+    newRun = np.ones(len(flatIndex), dtype=bool)
+    newRun[1:] = (np.diff(flatIndex) != 1) | (np.diff(rows) != 0)
+    first = np.flatnonzero(newRun)
+    lengths = np.diff(np.append(first, len(flatIndex)))
+    return rows[first], cols[first], lengths
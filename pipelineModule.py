@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Apr  1 10:12:47 2023
+
+@author: Magdalena Schneider, Janelia Research Campus
+
+Pipelined stages of the analysis of many cells: the next cells are loaded in a background thread
+and results are saved in a background thread, while the current cell is analyzed
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import traceModule as tr
+
+
+def prefetch(load, items, depth=1):
+    # Yields load(item) for all items in order, the next depth items are loaded in a background thread meanwhile.
+    # Errors of the loader are raised when its item is reached, depth=0 loads each item when it is requested.
+    if depth < 1:
+        for item in items:
+            yield load(item)
+        return
+    pool = ThreadPoolExecutor(max_workers=1)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(load, item))
+            if len(pending) > depth: # bounded number of loaded items waiting for the analysis
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Items not needed anymore (error or early stop of the analysis) are not loaded
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def getWriter(background=True, maxPending=4):
+    return BackgroundWriter(maxPending) if background else SerialWriter()
+
+class BackgroundWriter:
+    # Runs output jobs (saving, figures) in submission order in a background thread, at most maxPending jobs wait.
+    # Errors of a job are raised by a later submit or by close.
+    def __init__(self, maxPending=4):
+        self.maxPending = maxPending
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, *args):
+        if excType is None:
+            self.close()
+        else:
+            # Error of the analysis: stop without writing the waiting jobs
+            self.pool.shutdown(wait=True, cancel_futures=True)
+        return False
+
+    def submit(self, job, *args, **kwargs):
+        self.pending.append(self.pool.submit(runJob, job, *args, **kwargs))
+        while len(self.pending) > self.maxPending:
+            with tr.span('writer.wait'):
+                self.pending.popleft().result()
+
+    def wait(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.pool.shutdown(wait=True)
+
+class SerialWriter:
+    # Runs output jobs immediately, with the interface of BackgroundWriter
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def submit(self, job, *args, **kwargs):
+        runJob(job, *args, **kwargs)
+
+    def wait(self):
+        pass
+
+    def close(self):
+        pass
+
+def runJob(job, *args, **kwargs):
+    with tr.span(f'writer.{getattr(job, "__name__", "job")}'):
+        return job(*args, **kwargs)
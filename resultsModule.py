@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Mar 25 10:12:48 2023
+
+@author: Magdalena Schneider, Janelia Research Campus
+
+HDF5 result store for Ripley's curves, envelopes and integral matrices of many cells
+"""
+
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import ripleysModule as rm
+import traceModule as tr
+
+STORE_VERSION = 2 # increase whenever the layout of the store changes
+
+
+class RipleysResultStore:
+    # One HDF5 file for a whole study, pairs are written as soon as they are finished:
+    #   /cells/<cell>/integrals                    integral matrix (nFiles, nFiles), NaN for pairs not analyzed yet
+    #   /cells/<cell>/pairs/<idj>_<idk>/<name>     curves of one receptor pair, see getPairResults
+    # Small arrays are stored contiguous and uncompressed, so they can be memory-mapped. Control curves are chunked
+    # per control and compressed, slices of them are read lazily.
+    def __init__(self, file, mode='a', compression='gzip', compressionLevel=4, controlChunkSize=64):
+        folder = os.path.dirname(file)
+        if folder and (not os.path.exists(folder)):
+            os.makedirs(folder)
+        self.file = file
+        self.compression = compression
+        self.compressionLevel = compressionLevel if compression == 'gzip' else None
+        self.controlChunkSize = controlChunkSize # controls per chunk
+        import h5py
+        self.h5 = h5py.File(file, mode)
+        if self.h5.mode == 'r+':
+            if self.h5.attrs.setdefault('version', STORE_VERSION) != STORE_VERSION:
+                raise ValueError(f'Result store {file} has version {self.h5.attrs["version"]}, expected {STORE_VERSION}.')
+            self.h5.require_group('cells')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.h5.close()
+
+
+    #%% Writing
+
+    @tr.traced('store.writePair')
+    def writePair(self, cellName, fileIDs, j, k, pairResults):
+        cell = self.requireCell(cellName, fileIDs)
+        pairs = cell.require_group('pairs')
+        name = getPairName(fileIDs, j, k)
+        if name in pairs:
+            del pairs[name] # rerun of a pair replaces the previous results
+        pair = pairs.create_group(name)
+        pair.attrs['j'] = j
+        pair.attrs['k'] = k
+        for key, value in pairResults.items():
+            value = np.asarray(value)
+            if (key == 'controlsK') and (value.size > 0):
+                chunks = (min(len(value), self.controlChunkSize), value.shape[1])
+                pair.create_dataset(key, data=value, chunks=chunks, compression=self.compression,
+                                    compression_opts=self.compressionLevel, shuffle=self.compression is not None)
+            else:
+                pair.create_dataset(key, data=value)
+        cell['integrals'][j, k] = pairResults['integral']
+        self.h5.flush() # finished pairs survive an interrupted run
+
+    def requireCell(self, cellName, fileIDs):
+        cells = self.h5['cells']
+        if cellName in cells:
+            cell = cells[cellName]
+            if list(cell.attrs['fileIDs']) != [str(fileID) for fileID in fileIDs]:
+                raise ValueError(f'Cell {cellName} is stored with receptors {list(cell.attrs["fileIDs"])}.')
+            return cell
+        cell = cells.create_group(cellName)
+        cell.attrs['fileIDs'] = [str(fileID) for fileID in fileIDs]
+        nFiles = len(fileIDs)
+        integrals = cell.create_dataset('integrals', shape=(nFiles, nFiles), dtype=float, fillvalue=np.nan)
+        integrals[...] = np.nan # allocate now, so the matrix can be memory-mapped
+        return cell
+
+
+    #%% Reading
+
+    def getCells(self):
+        return list(self.h5['cells'])
+
+    def getFileIDs(self, cellName):
+        return list(self.h5['cells'][cellName].attrs['fileIDs'])
+
+    def hasPair(self, cellName, fileIDs, j, k):
+        path = f'cells/{cellName}/pairs/{getPairName(fileIDs, j, k)}'
+        return path in self.h5
+
+    def getPair(self, cellName, j, k):
+        # Dictionary of the pair's arrays: memory-mapped where possible, otherwise h5py datasets that are read on slicing
+        pair = self.h5['cells'][cellName]['pairs'][getPairName(self.getFileIDs(cellName), j, k)]
+        return {name: self.getArray(dataset) for name, dataset in pair.items()}
+
+    def readPair(self, cellName, j, k):
+        # Pair results as in-memory arrays, e.g. to send them to other processes
+        return {name: np.array(value) for name, value in self.getPair(cellName, j, k).items()}
+
+    def getIntegrals(self, cellName):
+        return self.getArray(self.h5['cells'][cellName]['integrals'])
+
+    def getMeanIntegrals(self, cellNames=None):
+        # Mean integral matrix over cells, accumulated one cell at a time
+        if cellNames is None:
+            cellNames = self.getCells()
+        total = 0
+        for cellName in cellNames:
+            total = total + self.getIntegrals(cellName)
+        return total / len(cellNames)
+
+    def getArray(self, dataset):
+        # Memory map for contiguous, uncompressed and allocated datasets, the dataset itself otherwise
+        offset = dataset.id.get_offset()
+        if (dataset.chunks is not None) or (offset is None) or (dataset.size == 0) or (dataset.shape == ()):
+            return dataset[()] if dataset.shape == () else dataset
+        return np.memmap(self.file, mode='r', dtype=dataset.dtype, offset=offset, shape=dataset.shape)
+
+
+    #%% Plotting
+
+    def plotPair(self, cellName, j, k, normalized=True, showControls=False, title=None, labelFontsize=14, axes=None, controlStyle='lines'):
+        plotPairResults(self.getPair(cellName, j, k), normalized=normalized, showControls=showControls, title=title,
+                        labelFontsize=labelFontsize, axes=axes, controlStyle=controlStyle)
+
+    def plotCell(self, cellName, normalized=True, showControls=True, controlStyle='collection', fig=None):
+        fileIDs = self.getFileIDs(cellName)
+        pairResults = [[self.getPair(cellName, j, k) for k in range(len(fileIDs))] for j in range(len(fileIDs))]
+        return plotReceptorMatrix(pairResults, fileIDs, normalized=normalized, showControls=showControls, controlStyle=controlStyle, fig=fig)
+
+    def saveCellFigures(self, cellName, path, filename, controlStyle='collection', parallel=True):
+        fileIDs = self.getFileIDs(cellName)
+        pairResults = [[self.readPair(cellName, j, k) for k in range(len(fileIDs))] for j in range(len(fileIDs))]
+        saveReceptorMatrixFigures(pairResults, fileIDs, path, filename, controlStyle=controlStyle, parallel=parallel)
+
+
+#%% Figures
+
+def plotPairResults(pairResults, normalized=True, showControls=False, title=None, labelFontsize=14, axes=None, controlStyle='lines'):
+    # Plot of stored pair results (see getPairResults), without a RipleysAnalysis object
+    envelope = rm.RipleysEnvelope(pairResults['envelopeMean'], pairResults['envelopeLow'], pairResults['envelopeHigh'], float(pairResults['ci']))
+    dataCurves = {'K': pairResults['dataK'], 'normalized': pairResults['dataNormalized']}
+    controlsK = pairResults['controlsK'][()] if (showControls and ('controlsK' in pairResults)) else None
+    rm.plotRipleysCurves(pairResults['radii'], envelope, dataCurves, controlsK=controlsK, normalized=normalized,
+                         title=title, labelFontsize=labelFontsize, axes=axes, controlStyle=controlStyle)
+
+def plotReceptorMatrix(pairResults, fileIDs, normalized=True, showControls=True, controlStyle='collection', figsize=30, labelFontsize=30, fig=None):
+    # nFiles x nFiles panels, pairResults[j][k] of receptor j with receptor k
+    if fig is None:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=(figsize, figsize))
+    nFiles = len(fileIDs)
+    axs = fig.subplots(nFiles, nFiles, squeeze=False)
+    for j in range(nFiles):
+        for k in range(nFiles):
+            plotPairResults(pairResults[j][k], normalized=normalized, showControls=showControls, controlStyle=controlStyle,
+                            title=f"Receptor {fileIDs[j]} with {fileIDs[k]}", labelFontsize=labelFontsize, axes=axs[j][k])
+    return fig
+
+def saveReceptorMatrix(file, pairResults, fileIDs, normalized=True, figsize=30, **kwargs):
+    # Renders with Agg into a standalone figure, independent of the pyplot backend and its open figures
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(figsize, figsize))
+    plotReceptorMatrix(pairResults, fileIDs, normalized=normalized, fig=fig, **kwargs)
+    fig.savefig(file)
+    return file
+
+@tr.traced('plot.figures')
+def saveReceptorMatrixFigures(pairResults, fileIDs, path, filename, controlStyle='collection', parallel=True):
+    # Normalized and unnormalized receptor matrix, rendered in two worker processes if parallel
+    files = {True: os.path.join(path, f'{filename}_ripleys_normalized'), False: os.path.join(path, f'{filename}_ripleys_unnormalized')}
+    if not parallel:
+        for normalized, file in files.items():
+            saveReceptorMatrix(file, pairResults, fileIDs, normalized=normalized, controlStyle=controlStyle)
+        return
+    with ProcessPoolExecutor(max_workers=len(files), mp_context=rm.getProcessContext()) as pool:
+        futures = [pool.submit(saveReceptorMatrix, file, pairResults, fileIDs, normalized=normalized, controlStyle=controlStyle)
+                   for normalized, file in files.items()]
+        for future in futures:
+            future.result()
+
+
+#%% Helper functions
+
+def getPairResults(results, ci=0.95):
+    # Arrays of a finished RipleysAnalysis or CrossRipleysAnalysis, as stored in checkpoints and the result store
+    envelope = results.getEnvelope(ci)
+    pairResults = {'integral': np.array(results.ripleysIntegral_data), 'radii': np.asarray(results.radii), 'ci': np.array(ci),
+                   'envelopeMean': envelope.mean, 'envelopeLow': envelope.low, 'envelopeHigh': envelope.high,
+                   'nControls': np.array(results.nControlsUsed)}
+    for name, curve in results.ripleysCurves_data.items():
+        pairResults[f'data{name[0].upper()}{name[1:]}'] = curve
+    if 'K' in results.ripleysCurves_controls:
+        pairResults['controlsK'] = results.ripleysCurves_controls['K']
+    return pairResults
+
+def getPairName(fileIDs, j, k):
+    return f'{fileIDs[j]}_{fileIDs[k]}'
+
+def getCellName(path, filename):
+    # Folder and file name, with a hash of the full path, as cells of different folders may share both (e.g. ./day1/Cell1 and ./day2/Cell1)
+    folder = os.path.normcase(os.path.abspath(path))
+    return f'{os.path.basename(folder)}_{filename}_{hashlib.sha256(folder.encode()).hexdigest()[:8]}'
@@ -5,35 +5,124 @@ Created on Thu Nov 10 23:26:00 2022
 @author: Magdalena Schneider, Janelia Research Campus
 """
 
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.spatial import KDTree
-from tqdm import tqdm
+import cacheModule as cm
+import countingModule as cnt
+import localModule as lm
+import streamingModule as sm
+import traceModule as tr
 
 
 #%% Class interface
 
 class RipleysInterface:
-    def __init__(self, radii, cellMask, nControls=100):
+    def __init__(self, radii, cellMask, nControls=100, nWorkers=1, seed=None, executor='process', cache=None, controlBatchSize=10, nullModel='montecarlo',
+                 streaming=False, tolerance=None, adaptiveStep=100, ciLevels=(0.95,), backend='auto', countThreads=1,
+                 histogramBinWidth=None, histogramRmax=None, subsampleSize=None, targetError=0.05, timeBudget=None, pilotSize=1000):
         self.nControls = nControls
         self.mask = cellMask
         self.radii = radii
+        self.nWorkers = nWorkers # number of parallel workers for random controls, None for all cores
+        self.seed = seed # seed for the random controls, None for fresh entropy
+        self.executor = executor # 'process' or 'thread'
+        self.cache = cache # ControlCache for random controls, only used with a fixed seed
+        self.controlBatchSize = controlBatchSize # controls counted together in one traversal
+        if nullModel not in ('montecarlo', 'analytic'):
+            raise ValueError('Invalid null model, use "montecarlo" or "analytic".')
+        self.nullModel = nullModel # 'montecarlo' for random controls, 'analytic' for expected K and variance under CSR in the mask
+        self.streaming = streaming or (tolerance is not None) # keep only running mean and envelope quantiles of the controls
+        self.tolerance = tolerance # adaptive mode: stop once the envelope converged, nControls is then the maximum
+        self.adaptiveStep = adaptiveStep # controls drawn between convergence checks in adaptive mode
+        self.ciLevels = ciLevels # confidence levels whose envelopes are tracked in streaming mode
+        self.nControlsUsed = None # number of random controls actually drawn
+        self.backend = backend # pair counting backend: 'kdtree', 'celllist' or 'auto'
+        self.countThreads = countThreads # threads counting the neighbors of the data in spatial blocks, None for all cores
+        self.histogramBinWidth = histogramBinWidth # count on a fine grid up to histogramRmax (default: largest radius) and interpolate, None to count at radii
+        self.histogramRmax = histogramRmax # cached counts on the same grid are shared by all radii up to histogramRmax
+        # Approximate mode: neighbors of a random subsample of subsampleSize query points (data and controls) against all points.
+        # 'auto' chooses the size from a pilot subsample, for a relative standard error of K of targetError and/or within timeBudget seconds.
+        self.subsampleSize = subsampleSize # None for exact counts
+        self.targetError = targetError
+        self.timeBudget = timeBudget
+        self.pilotSize = pilotSize
+        self.nQuery = None # number of query points in approximate mode, None for exact counts
+        self.envelopes = {} # RipleysEnvelope per confidence level
         
+    @property
+    def histogramRadii(self):
+        # Radii where neighbors are counted
+        return cnt.getHistogramRadii(self.radii, self.histogramBinWidth, self.histogramRmax)
     
+    @tr.traced('controls')
     def getRipleysRandomControlCurves(self, nPoints, cellMask, otherData=None):
+        from tqdm import tqdm
+        self.envelopes = {} # envelopes of previous controls are invalid
+        # Each control draws from its own random stream, so results do not depend on the number of workers
+        seedSequence = np.random.SeedSequence(self.seed)
+        # Regenerate first control in this process instead of sending control points back from the workers
+        firstSeed, = spawnControlSeeds(seedSequence.entropy, 1)
+        self.representativeData_control, *_ = cellMask.randomPoints(nPoints, rng=np.random.default_rng(firstSeed))
+        
+        if self.nullModel == 'analytic':
+            return self.getRipleysAnalyticControlCurves(nPoints, cellMask, otherData)
+        
+        useCache = (self.cache is not None) and (self.seed is not None)
+        if useCache:
+            subsampleOptions = {} if self.nQuery is None else {'nQuery': self.nQuery}
+            cacheKey = cm.getControlKey(cellMask, nPoints, self.histogramRadii, otherData, self.seed, self.nControls, **subsampleOptions,
+                                        streaming=self.streaming, tolerance=self.tolerance, adaptiveStep=self.adaptiveStep, ciLevels=self.ciLevels)
+            ripleysRandomControlCurves = self.cache.get(cacheKey)
+            if ripleysRandomControlCurves is not None:
+                print('Loading random controls from cache...')
+                tr.count('controls.cacheHits')
+                self.nControlsUsed = int(ripleysRandomControlCurves['nControls']) if self.streaming else self.nControls
+                return self.resampleControlCurves(ripleysRandomControlCurves)
+        
+        print('Generating random controls...')
+        controlTask = partial(getRipleysControlCurves, nPoints=nPoints, cellMask=cellMask,
+                              radii=self.histogramRadii, otherData=otherData, backend=self.backend, nQuery=self.nQuery)
+        with getControlPool(self.nWorkers, self.executor) as pool, tqdm(total=self.nControls) as progress:
+            if self.streaming:
+                ripleysRandomControlCurves = self.accumulateControlCurves(pool, controlTask, seedSequence, progress)
+            else:
+                ripleysRandomControlCurves = self.collectControlCurves(pool, controlTask, seedSequence, progress)
+        
+        tr.count('controls.drawn', self.nControlsUsed)
+        if useCache:
+            self.cache.put(cacheKey, ripleysRandomControlCurves)
+        return self.resampleControlCurves(ripleysRandomControlCurves)
+    
+    def resampleControlCurves(self, ripleysRandomControlCurves):
+        # Control curves counted on the histogram grid, at radii
+        if self.histogramBinWidth is None:
+            return ripleysRandomControlCurves
+        resampled = dict(ripleysRandomControlCurves)
+        for name in ('K', 'mean', 'std', 'quantiles'):
+            if name in resampled:
+                resampled[name] = cnt.resampleCumulative(resampled[name], self.histogramRadii, self.radii)
+        if 'K' in resampled:
+            resampled['L'] = np.sqrt(resampled['K'] / np.pi)
+            resampled['H'] = resampled['L'] - self.radii
+        return resampled
+    
+    def collectControlCurves(self, pool, controlTask, seedSequence, progress):
         K = []
         L = []
         H = []
-        print('Generating random controls...')
-        for j in tqdm(range(self.nControls)):
-            points, *_ = cellMask.randomPoints(nPoints)
-            if j==0:
-                self.representativeData_control = points
-            
-            ripleysCurves = self.getRipleysCurves(points, otherData=otherData, area=cellMask.area)
-            K.append(ripleysCurves['K'])
-            L.append(ripleysCurves['H'])
-            H.append(ripleysCurves['L'])
+        seeds = seedSequence.spawn(self.nControls)
+        for batchCurves in mapControls(pool, controlTask, seeds, self.controlBatchSize, self.nWorkers):
+            for ripleysCurves in batchCurves:
+                K.append(ripleysCurves['K'])
+                L.append(ripleysCurves['L'])
+                H.append(ripleysCurves['H'])
+            progress.update(len(batchCurves))
+        self.nControlsUsed = self.nControls
         
         meanControl = calculateRipleysMean(K)
         
@@ -41,152 +130,494 @@ class RipleysInterface:
                                       'H': np.array(H), 'mean': np.array(meanControl)}
         return ripleysRandomControlCurves
     
-    def getRipleysDataCurves(self, data, otherData=None, area=None):
-        ripleysCurves = self.getRipleysCurves(data, otherData, area=area)
+    def accumulateControlCurves(self, pool, controlTask, seedSequence, progress):
+        # Only the running mean and envelope quantiles are kept. In adaptive mode (tolerance set), controls are drawn
+        # in steps until no envelope bound moves by more than the tolerance (relative to its distance from the mean).
+        accumulator = sm.ControlAccumulator(sm.getQuantileLevels(self.ciLevels))
+        previousQuantiles = None
+        while accumulator.count < self.nControls:
+            nStep = self.nControls - accumulator.count
+            if self.tolerance is not None:
+                nStep = min(self.adaptiveStep, nStep)
+            for batchCurves in mapControls(pool, controlTask, seedSequence.spawn(nStep), self.controlBatchSize, self.nWorkers):
+                accumulator.add([ripleysCurves['K'] for ripleysCurves in batchCurves])
+                progress.update(len(batchCurves))
+            if self.tolerance is not None:
+                quantiles = accumulator.getQuantiles()
+                if (previousQuantiles is not None) and (sm.getEnvelopeChange(quantiles, previousQuantiles, accumulator.getMean()) < self.tolerance):
+                    break
+                previousQuantiles = quantiles
+        self.nControlsUsed = accumulator.count
+        if self.tolerance is not None:
+            print(f'Envelope converged after {accumulator.count} random controls' if accumulator.count < self.nControls
+                  else f'Envelope not converged after maximum of {accumulator.count} random controls')
+        return accumulator.getControlCurves()
+    
+    def getRipleysAnalyticControlCurves(self, nPoints, cellMask, otherData=None):
+        print('Calculating analytic null model...')
+        nOther = None if otherData is None else getNumberPoints(otherData)
+        meanK, stdK = getAnalyticRipleysMoments(nPoints, cellMask, self.radii, nOther)
+        self.nControlsUsed = 0
+        return {'mean': meanK, 'std': stdK}
+    
+    def getRipleysDataCurves(self, data, otherData=None, area=None, nNeighbors=None):
+        if (nNeighbors is None) and (self.nQuery is not None):
+            ripleysCurves = self.getRipleysSubsampleCurves(data, otherData, area=area)
+        else:
+            ripleysCurves = self.getRipleysCurves(data, otherData, area=area, nNeighbors=nNeighbors)
         ripleysCurves['normalized'] = self.normalizeCurve(ripleysCurves['K'])
         return ripleysCurves
     
-    def getRipleysCurves(self, data, otherData=None, area=None):
-        assert (area is not None), "Input parameter area not specified, area is None"
-        
+    def getRipleysCurves(self, data, otherData=None, area=None, nNeighbors=None):
+        if nNeighbors is None:
+            nNeighbors = self.getDataCounts(data, otherData)
+        return getRipleysCurves(data, self.radii, otherData=otherData, area=area, nNeighbors=nNeighbors, backend=self.backend, nThreads=self.countThreads)
+    
+    def getDataCounts(self, data, otherData=None):
+        # Cumulative neighbor counts at radii, cross counts of (data, otherData) equal those of (otherData, data)
+        if self.histogramBinWidth is not None:
+            return cnt.resampleCumulative(self.getDataHistogram(data, otherData), self.histogramRadii, self.radii)
+        return getRipleysNeighbors(data, self.radii, otherData, self.backend, self.countThreads)
+    
+    def getRipleysSubsampleCurves(self, data, otherData=None, area=None):
+        # Curves estimated from the neighbors of nQuery random points, with the standard error of K per radius
         n1 = getNumberPoints(data)
-        
-        if otherData is None:
-            density = n1 / area
-            
-            tree = getTree(data)  
-            nNeighbors = tree.count_neighbors(tree, self.radii) - n1
-        else:
-            n2 = getNumberPoints(otherData)
-            density = n2 / area
-            
-            tree = getTree(data)
-            otherTree = getTree(otherData)
-            nNeighbors = tree.count_neighbors(otherTree, self.radii)
-        
-        K = ((nNeighbors / n1) / density)
-        L = np.sqrt(K / np.pi)
-        H = L - self.radii
-        
-        ripleysCurves = {'K': np.array(K), 'L': np.array(L), 'H': np.array(H)}
+        counts = getSubsampleCounts(data, self.radii, self.nQuery, otherData, self.backend, self.seed)
+        ripleysCurves = self.getRipleysCurves(data, otherData, area=area, nNeighbors=counts.mean(axis=0) * n1)
+        density = (n1 if otherData is None else getNumberPoints(otherData)) / area
+        finitePopulation = np.sqrt(1 - (self.nQuery - 1) / max(n1 - 1, 1))
+        ripleysCurves['standardError'] = counts.std(axis=0, ddof=1) / np.sqrt(self.nQuery) * finitePopulation / density
         return ripleysCurves
     
+    def getSubsampleSize(self, data, otherData=None):
+        # Number of query points in approximate mode, None for exact counts
+        n1 = getNumberPoints(data)
+        if self.subsampleSize is None:
+            return None
+        if self.subsampleSize != 'auto':
+            return int(np.clip(self.subsampleSize, min(2, n1), n1))
+        # Spread of the neighbor counts per point and counting time per query point of a pilot subsample
+        nPilot = min(self.pilotSize, n1)
+        tstart = time.perf_counter()
+        counts = getSubsampleCounts(data, self.radii, nPilot, otherData, self.backend, self.seed)
+        timePerPoint = (time.perf_counter() - tstart) / nPilot
+        nQuery = n1
+        if self.targetError is not None:
+            # Relative standard error of the mean count, at radii with at least one neighbor per point on average
+            mean = counts.mean(axis=0)
+            valid = mean >= 1
+            if np.any(valid):
+                relativeVariance = np.max(counts.var(axis=0, ddof=1)[valid] / mean[valid]**2) / self.targetError**2
+                nQuery = min(nQuery, int(np.ceil(relativeVariance / (1 + relativeVariance / n1))))
+        if self.timeBudget is not None:
+            # Data and all controls are counted with the same number of query points
+            nQuery = min(nQuery, int(self.timeBudget / (timePerPoint * (1 + self.nControls))))
+        nQuery = max(nQuery, nPilot)
+        if nQuery > n1 / 2:
+            return None # counting more than half of the points per point is slower than exact counts
+        print(f'Approximate mode with {nQuery} of {n1} query points')
+        return nQuery
+    
+    def getDataHistogram(self, data, otherData=None):
+        # Cumulative neighbor counts of the data on the histogram grid, counted once per data set if a cache is given
+        cacheKey = None if self.cache is None else cm.getHistogramKey([data, otherData], self.histogramRadii)
+        if cacheKey is not None:
+            histogram = self.cache.get(cacheKey)
+            if histogram is not None:
+                tr.count('counting.histogramCacheHits')
+                return histogram['counts']
+        nNeighbors = getRipleysNeighbors(data, self.histogramRadii, otherData, self.backend, self.countThreads)
+        if cacheKey is not None:
+            self.cache.put(cacheKey, {'counts': nNeighbors})
+        return nNeighbors
+    
     def normalizeCurve(self, K, ci=0.95):
-        ripleysMean = self.getRipleysMean()
-        Knormalized = (K - ripleysMean)
-        
-        quantileLow = (1-ci) / 2
-        quantileHigh = 1 - (1-ci)/2
-        # Divide all positive values by high quantile:
-        idxPos = (Knormalized >=0)
-        quantilesHigh = self.getRipleysQuantiles(quantileHigh)
-        Knormalized[idxPos] /= abs((quantilesHigh[idxPos] - ripleysMean[idxPos]))
-        # Divide all negative values by low quantile:
-        quantilesLow = self.getRipleysQuantiles(quantileLow)
-        Knormalized[~idxPos] /= abs((quantilesLow[~idxPos] - ripleysMean[~idxPos]))
-        
-        return Knormalized
+        # K can be a single curve or an array of curves of shape (nCurves, nRadii)
+        return self.getEnvelope(ci).normalize(K)
+    
+    def getEnvelope(self, ci=0.95):
+        # Mean and envelope of the controls, computed once per confidence level
+        if ci not in self.envelopes:
+            quantileLow = (1-ci) / 2
+            quantileHigh = 1 - (1-ci)/2
+            low, high = self.getRipleysQuantiles([quantileLow, quantileHigh])
+            self.envelopes[ci] = RipleysEnvelope(self.getRipleysMean(), low, high, ci)
+        return self.envelopes[ci]
     
     def getRipleysMean(self):
         return self.ripleysCurves_controls['mean']
     
     def getRipleysQuantiles(self, quantile):
-        quantilesK = [np.quantile(x, quantile) for x in np.transpose(self.ripleysCurves_controls['K'])]
-        return np.array(quantilesK)
+        # quantile can be a single value or a list of values, one row of quantiles per value
+        if 'quantiles' in self.ripleysCurves_controls:
+            # Streaming controls only track the quantiles of their confidence levels
+            levels = self.ripleysCurves_controls['quantileLevels']
+            index = []
+            for q in np.atleast_1d(quantile):
+                match = np.flatnonzero(np.isclose(levels, q))
+                if len(match) == 0:
+                    raise ValueError(f'Quantile {q:.4g} not tracked by streaming controls, set ciLevels accordingly.')
+                index.append(match[0])
+            quantiles = self.ripleysCurves_controls['quantiles'][index]
+            return quantiles if np.ndim(quantile) else quantiles[0]
+        if 'K' not in self.ripleysCurves_controls:
+            # Normal approximation around the analytic mean
+            from scipy.stats import norm
+            return self.ripleysCurves_controls['mean'] + np.multiply.outer(norm.ppf(quantile), self.ripleysCurves_controls['std'])
+        return np.quantile(self.ripleysCurves_controls['K'], quantile, axis=0)
 
     def calculateRipleysIntegral(self,interval=None):
         if interval==None:
             integral = np.trapz(self.ripleysCurves_data['normalized'], self.radii)
         else:
-            f_limits = np.interp(interval, self.ripleysCurves_data['normalized'], self.radii)
-            f = [f_limits[0], self.ripleysCurves_data['normalized'], f_limits[1]]
-            x = [interval[0], self.radii, interval[1]]
+            # Normalized curve within the interval, interpolated at its limits
+            inside = (self.radii > interval[0]) & (self.radii < interval[1])
+            x = np.concatenate(([interval[0]], self.radii[inside], [interval[1]]))
+            f = np.interp(x, self.radii, self.ripleysCurves_data['normalized'])
             integral = np.trapz(f, x)
         return integral
     
-    def plot(self, ci=0.95, normalized=True, showControls=False, title=None, labelFontsize=14, axes=None):
+    def plot(self, ci=0.95, normalized=True, showControls=False, title=None, labelFontsize=14, axes=None, controlStyle='lines'):
         # Plot Ripley's K and confidence interval
-        if axes is None:
-            plt.figure()
-            axes=plt.gca()
-        if normalized:
-            if showControls:
-                for k in range(self.nControls):
-                    axes.plot(self.radii, self.normalizeCurve(self.ripleysCurves_controls['K'][k]), c="lightgray", label="Random controls", linestyle="-")
-            axes.plot(self.radii, np.zeros(len(self.radii)), c="k", label=f"{ci*100}% envelope", linestyle="--")
-            axes.plot(self.radii, np.ones(len(self.radii)), c="k", linestyle=":")
-            axes.plot(self.radii, -np.ones(len(self.radii)), c="k", linestyle=":")
-            axes.plot(self.radii, self.ripleysCurves_data['normalized'], c="k", label="Observed data", linewidth=2.0)
-            axes.set_xlabel("d (nm)", fontsize=labelFontsize)
-            axes.set_ylabel("Normalized K(d)", fontsize=labelFontsize)
-        else:
-            if showControls:
-                for k in range(self.nControls):
-                    axes.plot(self.radii, self.ripleysCurves_controls['K'][k], c="lightgray", label="Random controls", linestyle="-")
-            quantileLow = (1-ci) / 2
-            quantileHigh = 1 - (1-ci)/2
-            axes.plot(self.radii, self.ripleysCurves_controls['mean'], c="k", label="Mean of random controls", linestyle="--")
-            axes.plot(self.radii, self.getRipleysQuantiles(quantileHigh), c="k", label=f"{ci*100}% envelope", linestyle=":")
-            axes.plot(self.radii, self.getRipleysQuantiles(quantileLow), c="k", linestyle=":")
-            axes.plot(self.radii, self.ripleysCurves_data['K'], c="k", label="Observed data", linewidth=1.0)
-            axes.set_xlabel("d (nm)", fontsize=labelFontsize)
-            axes.set_ylabel("K(d)", fontsize=labelFontsize)
-            
-        handles, labels = plt.gca().get_legend_handles_labels()
-        by_label = dict(zip(labels, handles))
-        plt.legend(by_label.values(), by_label.keys(), fontsize=labelFontsize)
-        
-        if title is not None:
-            axes.set_title(title, fontsize=labelFontsize)
+        controlsK = self.ripleysCurves_controls.get('K') if showControls else None
+        plotRipleysCurves(self.radii, self.getEnvelope(ci), self.ripleysCurves_data, controlsK=controlsK, normalized=normalized,
+                          title=title, labelFontsize=labelFontsize, axes=axes, controlStyle=controlStyle)
         
             
     def plotRepresentativeControl(self, title='Random control', axes=None):
+        import matplotlib.pyplot as plt
         if axes is None:
             plt.figure()
             axes=plt.gca()
         points = self.representativeData_control
         axes.plot(points[:,0],points[:,1],'.',markersize=1)
-        axes.xlim(0,self.mask.shape[0]*self.mask.pixelsize)
-        axes.ylim(0,self.mask.shape[1]*self.mask.pixelsize)
+        xmin, xmax, ymin, ymax = self.mask.getExtent()
+        axes.set_xlim(xmin, xmax)
+        axes.set_ylim(ymin, ymax)
         axes.set_aspect('equal')
         axes.set_title(title)
     
     
+#%% Envelope
+
+class RipleysEnvelope:
+    def __init__(self, mean, low, high, ci):
+        self.mean = np.asarray(mean)
+        self.low = np.asarray(low) # low quantile of the controls
+        self.high = np.asarray(high) # high quantile of the controls
+        self.ci = ci
+        
+    def normalize(self, K):
+        # Positive deviations from the mean are divided by the distance to the high quantile, negative ones by the distance to the low quantile
+        Knormalized = np.asarray(K, dtype=float) - self.mean
+        scale = np.where(Knormalized >= 0, abs(self.high - self.mean), abs(self.low - self.mean))
+        return Knormalized / scale
+    
+    
+#%% Plotting
+
+def plotRipleysCurves(radii, envelope, dataCurves, controlsK=None, normalized=True, title=None, labelFontsize=14, axes=None, controlStyle='lines'):
+    # Plot observed curves (K and normalized) against the envelope, used for analysis objects and stored results
+    import matplotlib.pyplot as plt
+    if axes is None:
+        plt.figure()
+        axes=plt.gca()
+    ci = envelope.ci
+    if normalized:
+        if controlsK is not None:
+            plotControls(axes, radii, envelope.normalize(controlsK), controlStyle)
+        axes.plot(radii, np.zeros(len(radii)), c="k", label=f"{ci*100}% envelope", linestyle="--")
+        axes.plot(radii, np.ones(len(radii)), c="k", linestyle=":")
+        axes.plot(radii, -np.ones(len(radii)), c="k", linestyle=":")
+        axes.plot(radii, dataCurves['normalized'], c="k", label="Observed data", linewidth=2.0)
+        axes.set_xlabel("d (nm)", fontsize=labelFontsize)
+        axes.set_ylabel("Normalized K(d)", fontsize=labelFontsize)
+    else:
+        if controlsK is not None:
+            plotControls(axes, radii, np.asarray(controlsK), controlStyle)
+        axes.plot(radii, envelope.mean, c="k", label="Mean of random controls", linestyle="--")
+        axes.plot(radii, envelope.high, c="k", label=f"{ci*100}% envelope", linestyle=":")
+        axes.plot(radii, envelope.low, c="k", linestyle=":")
+        axes.plot(radii, dataCurves['K'], c="k", label="Observed data", linewidth=1.0)
+        axes.set_xlabel("d (nm)", fontsize=labelFontsize)
+        axes.set_ylabel("K(d)", fontsize=labelFontsize)
+        
+    handles, labels = axes.get_legend_handles_labels()
+    by_label = dict(zip(labels, handles))
+    axes.legend(by_label.values(), by_label.keys(), fontsize=labelFontsize)
+    
+    if title is not None:
+        axes.set_title(title, fontsize=labelFontsize)
+
+def plotControls(axes, radii, controls, controlStyle='lines'):
+    # 'lines': one line per control, 'collection': all controls as a single rasterized artist, 'band': range of the controls
+    from matplotlib.collections import LineCollection
+    if controlStyle == 'lines':
+        axes.plot(radii, controls.T, c="lightgray", label="Random controls", linestyle="-")
+    elif controlStyle == 'collection':
+        segments = np.stack(np.broadcast_arrays(np.asarray(radii, dtype=float), controls), axis=2)
+        axes.add_collection(LineCollection(segments, colors="lightgray", label="Random controls", rasterized=True))
+        axes.autoscale_view()
+    elif controlStyle == 'band':
+        finite = np.where(np.isfinite(controls), controls, np.nan)
+        axes.fill_between(radii, np.nanmin(finite, axis=0), np.nanmax(finite, axis=0), color="lightgray", linewidth=0, label="Random controls")
+    else:
+        raise ValueError('Invalid control style, use "lines", "collection" or "band".')
+    
+    
 #%% Subclasses
     
 class RipleysAnalysis(RipleysInterface):
-    def __init__(self, data, radii, cellMask, nControls):
-        super().__init__(radii, cellMask, nControls)
+    def __init__(self, data, radii, cellMask, nControls, dataCounts=None, **kwargs):
+        super().__init__(radii, cellMask, nControls, **kwargs)
+        self.nQuery = self.getSubsampleSize(data)
         self.ripleysCurves_controls = self.getRipleysRandomControlCurves(getNumberPoints(data), cellMask)  # dictionary: K, H, L, normalized (lists)
-        self.ripleysCurves_data = self.getRipleysDataCurves(data, area=cellMask.area) # dictionary: K, H, L, normalized
+        self.ripleysCurves_data = self.getRipleysDataCurves(data, area=cellMask.area, nNeighbors=dataCounts) # dictionary: K, H, L, normalized
         self.representativeData_control # list
         self.ripleysIntegral_data = self.calculateRipleysIntegral()
 
         
 class CrossRipleysAnalysis(RipleysInterface):
-    def __init__(self, data, otherData, radii, cellMask, nControls):
-        super().__init__(radii, cellMask, nControls)
+    def __init__(self, data, otherData, radii, cellMask, nControls, dataCounts=None, **kwargs):
+        super().__init__(radii, cellMask, nControls, **kwargs)
+        self.nQuery = self.getSubsampleSize(data, otherData)
         self.ripleysCurves_controls = self.getRipleysRandomControlCurves(getNumberPoints(data), cellMask, otherData)  # dictionary: K, H, L, normalized (lists)
-        self.ripleysCurves_data = self.getRipleysDataCurves(data, otherData, area=cellMask.area) # dictionary: K, H, L, normalized
+        self.ripleysCurves_data = self.getRipleysDataCurves(data, otherData, area=cellMask.area, nNeighbors=dataCounts) # dictionary: K, H, L, normalized
         self.representativeData_control # list
         self.ripleysIntegral_data = self.calculateRipleysIntegral()
+
+
+class IncrementalRipleysAnalysis(RipleysInterface):
+    # Ripley's analysis of localizations arriving in batches, e.g. during an acquisition. Neighbor counts are updated with
+    # the pairs involving new points only. Random controls are drawn again only once the number of points changed by more
+    # than refreshTolerance (relative) since the last controls. With cross=True, both point sets can grow.
+    def __init__(self, radii, cellMask, nControls, cross=False, refreshTolerance=0.1, **kwargs):
+        super().__init__(radii, cellMask, nControls, **kwargs)
+        self.cross = cross
+        self.refreshTolerance = refreshTolerance
+        backend = 'kdtree' if self.backend == 'auto' else self.backend # the final number of points is not known
+        self.index = cnt.IncrementalIndex(backend, np.max(radii))
+        self.otherIndex = cnt.IncrementalIndex(backend, np.max(radii)) if cross else None
+        self.nNeighbors = np.zeros(len(radii), dtype=np.int64) # cumulative neighbor counts of all points added so far
+        self.ripleysCurves_controls = None
+        self.controlPoints = None # numbers of points (data, other data) the controls were drawn for
+        self.nControlRefreshes = 0
+        self.ripleysCurves_data = None
+        self.ripleysIntegral_data = None
+    
+    @property
+    def nPoints(self):
+        return self.index.n
+    
+    @property
+    def nOther(self):
+        return self.otherIndex.n if self.cross else None
+    
+    def addPoints(self, points=None, otherPoints=None):
+        # Appends a batch of localizations (otherPoints: batch of the other receptor for cross Ripley's) and updates the curves
+        with tr.span('incremental.add'):
+            if otherPoints is not None:
+                if not self.cross:
+                    raise ValueError('Other points require an analysis with cross=True.')
+                otherPoints = cnt.getPoints(otherPoints)
+                self.nNeighbors += self.index.countNeighbors(otherPoints, self.radii, self.countThreads) # existing points vs new other points
+                self.otherIndex.add(otherPoints)
+            if points is not None:
+                points = cnt.getPoints(points)
+                if self.cross:
+                    self.nNeighbors += self.otherIndex.countNeighbors(points, self.radii, self.countThreads)
+                elif len(points):
+                    # Ordered pairs: pairs of new and existing points count twice, plus the pairs among the new points
+                    self.nNeighbors += 2 * self.index.countNeighbors(points, self.radii, self.countThreads)
+                    self.nNeighbors += self.index.backend.countNeighbors(points, None, self.radii, nThreads=self.countThreads)
+                self.index.add(points)
+        return self.update()
+    
+    def update(self):
+        # Curves of all points added so far, random controls are only drawn again if the number of points drifted
+        if (self.nPoints < 2) or (self.cross and (self.nOther == 0)):
+            return self
+        if self.needsControlRefresh():
+            self.refreshControls()
+        density = (self.nOther if self.cross else self.nPoints) / self.mask.area
+        self.ripleysCurves_data = getRipleysCurvesFromCounts(self.nNeighbors, self.nPoints, density, self.radii)
+        self.ripleysCurves_data['normalized'] = self.normalizeCurve(self.ripleysCurves_data['K'])
+        self.ripleysIntegral_data = self.calculateRipleysIntegral()
+        return self
+    
+    def needsControlRefresh(self):
+        if self.ripleysCurves_controls is None:
+            return True
+        current = (self.nPoints, self.nOther)
+        return any(abs(n - nControl) > self.refreshTolerance * nControl for n, nControl in zip(current, self.controlPoints) if n is not None)
+    
+    def refreshControls(self):
+        otherData = self.otherIndex.getPoints() if self.cross else None
+        self.ripleysCurves_controls = self.getRipleysRandomControlCurves(self.nPoints, self.mask, otherData)
+        self.controlPoints = (self.nPoints, self.nOther)
+        self.nControlRefreshes += 1
+        tr.count('incremental.controlRefreshes')
+      
+        
+#%% Tiles
+
+def analyzeTiles(data, cellMask, tileShape, radii, nControls, otherData=None, nWorkers=None, minPoints=2, **kwargs):
+    # Ripley's analysis (cross Ripley's with otherData) of every tile of a large field on its own, tiles run in parallel processes.
+    # Pairs across tile borders are not counted. Returns the tiles with at least minPoints points and their results.
+    data = cnt.getPoints(data)
+    otherData = None if otherData is None else cnt.getPoints(otherData)
+    tiles = []
+    tasks = []
+    for tile in cellMask.getTiles(tileShape):
+        tileData = data[tile.contains(data)]
+        tileOtherData = None if otherData is None else otherData[tile.contains(otherData)]
+        if (len(tileData) < minPoints) or ((tileOtherData is not None) and (len(tileOtherData) < minPoints)):
+            continue
+        tiles.append(tile)
+        tasks.append((tileData, tileOtherData, tile))
+    tileTask = partial(analyzeTile, radii=radii, nControls=nControls, **kwargs)
+    with getControlPool(nWorkers) as pool:
+        results = list(pool.map(tileTask, tasks))
+    return tiles, results
+
+def analyzeTile(task, radii, nControls, **kwargs):
+    data, otherData, tileMask = task
+    if otherData is None:
+        return RipleysAnalysis(data, radii, tileMask, nControls, **kwargs)
+    return CrossRipleysAnalysis(data, otherData, radii, tileMask, nControls, **kwargs)
       
         
 #%% Helper functions
 
+def getRipleysCurves(data, radii, otherData=None, area=None, nNeighbors=None, backend='auto', nThreads=1):
+    assert (area is not None), "Input parameter area not specified, area is None"
+    
+    n1 = getNumberPoints(data)
+    density = (n1 if otherData is None else getNumberPoints(otherData)) / area
+    if nNeighbors is None:
+        nNeighbors = getRipleysNeighbors(data, radii, otherData, backend, nThreads)
+    
+    return getRipleysCurvesFromCounts(nNeighbors, n1, density, radii)
+
+def getRipleysNeighbors(data, radii, otherData=None, backend='auto', nThreads=1):
+    # Cumulative neighbor counts of data (among itself or in otherData)
+    n1 = getNumberPoints(data)
+    if otherData is None:
+        with tr.span('counting.data', nPoints=n1):
+            return getBackend(backend, data, radii).countNeighbors(data, None, radii, nThreads=nThreads)
+    with tr.span('counting.data', nPoints=n1, nOther=getNumberPoints(otherData)):
+        return getBackend(backend, otherData, radii).countNeighbors(data, otherData, radii, nThreads=nThreads)
+
+def getRipleysCurvesFromCounts(nNeighbors, n1, density, radii):
+    K = ((nNeighbors / n1) / density)
+    L = np.sqrt(K / np.pi)
+    H = L - radii
+    
+    ripleysCurves = {'K': np.array(K), 'L': np.array(L), 'H': np.array(H)}
+    return ripleysCurves
+
+@tr.traced('controls.batch')
+def getRipleysControlCurves(seeds, nPoints, cellMask, radii, otherData=None, backend='auto', nQuery=None):
+    # Random controls for a batch of seeds, counted in a single traversal.
+    # With nQuery, counts are estimated from the first nQuery points of each control (uniform, thus a random subsample).
+    controls = cellMask.randomPointsBatch(len(seeds), nPoints, rng=[np.random.default_rng(seed) for seed in seeds])
+    nNeighbors = cnt.countControlBatch(controls, radii, otherPoints=otherData, backend=backend, nQuery=nQuery)
+    if nQuery is not None:
+        nNeighbors = nNeighbors * (nPoints / min(nQuery, nPoints))
+    ripleysCurves = []
+    for points, controlNeighbors in zip(controls, nNeighbors):
+        n1 = getNumberPoints(points)
+        density = (n1 if otherData is None else getNumberPoints(otherData)) / cellMask.area
+        ripleysCurves.append(getRipleysCurvesFromCounts(controlNeighbors, n1, density, radii))
+    return ripleysCurves
+
+def getSubsampleCounts(data, radii, nQuery, otherData=None, backend='auto', seed=None):
+    # Neighbor counts of nQuery random points of data against all points (of otherData), shape (nQuery, nRadii)
+    points = cnt.getPoints(data)
+    query = points[np.sort(np.random.default_rng(seed).choice(len(points), nQuery, replace=False))]
+    reference = data if otherData is None else otherData
+    backend = getBackend(backend, reference, radii)
+    counts = lm.countPointNeighbors(query, backend.buildIndex(reference, np.max(radii)), np.asarray(radii, dtype=float), backend)
+    tr.count('counting.subsamplePoints', nQuery)
+    return counts - 1 if otherData is None else counts # query points are paired with themselves
+
+def getAnalyticRipleysMoments(nPoints, cellMask, radii, nOther=None):
+    # Mean and standard deviation of K under CSR of nPoints uniform points in the mask.
+    # Pair counts are U-statistics with kernel 1(|X-Y| <= r): zeta2 = Var(kernel), zeta1 = Var over X of its conditional mean.
+    # For cross analyses, the fixed other points are approximated as uniformly distributed in the mask.
+    area = cellMask.area
+    pairProbability, coverageVariance = cellMask.getCSRMoments(radii)
+    zeta1 = coverageVariance
+    zeta2 = pairProbability * (1 - pairProbability)
+    n1 = nPoints
+    if nOther is None:
+        meanK = area * (n1-1) / n1 * pairProbability
+        varNeighbors = 2 * n1 * (n1-1) * (2*(n1-2)*zeta1 + zeta2) # ordered pairs, i.e. 4 * Var(unordered pairs)
+        varK = (area / n1**2)**2 * varNeighbors
+    else:
+        n2 = nOther
+        meanK = area * pairProbability
+        varNeighbors = n1 * (n2*zeta2 + n2*(n2-2)*zeta1)
+        varK = (area / (n1*n2))**2 * varNeighbors
+    return meanK, np.sqrt(np.clip(varK, 0, None))
+
+def spawnControlSeeds(seed, nControls):
+    return np.random.SeedSequence(seed).spawn(nControls)
+
+def getProcessContext():
+    # Worker processes start from a fresh server process (forkserver, spawn where it is not available) instead of a fork of
+    # this process: a fork copies locks held by other threads (e.g. the pipeline's loader and writer in h5py) into the child
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['resultsModule']) # imported once in the server, not in every worker
+        return context
+    return multiprocessing.get_context('spawn')
+
+def getControlPool(nWorkers=1, executor='process'):
+    if nWorkers is None:
+        nWorkers = os.cpu_count()
+    if nWorkers <= 1:
+        return SerialPool()
+    if executor == 'process':
+        return ProcessPoolExecutor(max_workers=nWorkers, mp_context=getProcessContext()) # the pipeline's threads run meanwhile
+    elif executor == 'thread':
+        return ThreadPoolExecutor(max_workers=nWorkers)
+    else:
+        raise ValueError('Invalid executor, use "process" or "thread".')
+
+def mapControls(pool, task, seeds, batchSize, nWorkers=1):
+    batches = [seeds[b:b+batchSize] for b in range(0, len(seeds), batchSize)]
+    chunksize = max(1, len(batches) // (4*cnt.getNumberThreads(nWorkers))) # send mask and other data once per chunk, not per batch
+    return pool.map(task, batches, chunksize=chunksize)
+
+class SerialPool:
+    # Runs tasks in this process, with the interface of the concurrent.futures executors
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        return False
+    
+    def map(self, task, iterable, chunksize=1):
+        return map(task, iterable)
+
 def calculateRipleysMean(Ks):
     meanK = np.mean(Ks, 0)
     return meanK
 
 def isTree(data):
-    return isinstance(data, KDTree)
+    return isinstance(data, (KDTree, cnt.CellList))
 
-def getTree(data):
-    if isTree(data):
-        tree = data
-    else:
-        tree = KDTree(data)
-    return tree
+def getTree(data, backend='kdtree', rmax=None):
+    # Spatial index of the given backend, existing indices are reused
+    return cnt.getBackend(backend).buildIndex(data, rmax)
+
+def getBackend(backend, data, radii):
+    # Backend for searching neighbors among data, 'auto' selects by number of points and maximum radius
+    if backend != 'auto':
+        return cnt.getBackend(backend)
+    points = cnt.getPoints(data)
+    return cnt.getBackend('auto', len(points), np.max(radii), cnt.getExtent(points))
 
 def getNumberPoints(data):
     if isTree(data):
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Mar 26 17:02:10 2023
+
+@author: Magdalena Schneider, Janelia Research Campus
+
+Script for benchmarks of the Ripley's pipeline on synthetic data
+"""
+
+import sys
+import numpy as np
+import benchmarkModule as bm
+
+
+#%% Set parameters
+
+patterns = ['csr', 'thomas', 'matern', 'cocluster']
+sizes = [10**3, 10**4, 10**5, 10**6, 10**7]
+maxPoints = {'getRipleysRandomControlCurves': 10**6, 'normalizeCurve': 10**6, 'multiAnalysis': 10**6} # skip expensive stages for larger patterns
+nControls = 10
+repeats = 3
+backend = 'auto'
+rmax = 200
+radii = np.concatenate((np.arange(4, 80, 2), np.arange(80, rmax+1, 12)))
+
+outputFile = "./benchmark.json"
+baselineFile = None # stored benchmark to compare with, e.g. "./benchmark_baseline.json", None to skip the comparison
+timeTolerance = 0.2 # relative slowdown flagged as regression
+memoryTolerance = 0.2 # relative increase of peak memory flagged as regression
+
+
+#%% Run benchmarks
+
+benchmarks = bm.runBenchmarks(patterns, sizes, radii=radii, nControls=nControls, repeats=repeats, maxPoints=maxPoints, backend=backend)
+bm.printBenchmarks(benchmarks)
+bm.saveBenchmarks(outputFile, benchmarks)
+print(f'Benchmarks saved in {outputFile}')
+
+if baselineFile is not None:
+    regressions = bm.compareBenchmarks(benchmarks, bm.loadBenchmarks(baselineFile), timeTolerance, memoryTolerance)
+    bm.printRegressions(regressions)
+    if regressions:
+        sys.exit(1)
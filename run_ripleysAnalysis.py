@@ -9,24 +9,34 @@ Script for Ripley's Analysis of multiplexed single molecule localization data
 
 import os
 import time
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
 import maskModule as mm
 import dataModule as dm
 import ripleysModule as rm
+import cacheModule as cm
+import countingModule as cnt
+import schedulerModule as sch
+import resultsModule as rs
+import traceModule as tr
+import localModule as lm
+import pipelineModule as pl
 
-np.random.seed(0) # initialize random seed
-
-tstart = time.time()
-
-
-def performRipleysMultiAnalysis(path, filename, fileIDs, radii, nRandomControls=100):
+def performRipleysMultiAnalysis(path, filename, fileIDs, radii, nRandomControls=100, seed=0, nWorkers=1, cache=None, nullModel='montecarlo', tolerance=None, backend='auto', dtype=np.float64, useIndexCache=True, resultStore=None,
+                                saveFigures=True, controlStyle='collection', parallelFigures=True, sparseMask=False,
+                                localRipleys=False, countThreads=1, histogramBinWidth=None, subsampleSize=None, targetError=0.05, timeBudget=None,
+                                cell=None, writer=None):
+    # cell: (locData, cellMask) loaded in advance by loadCell, None to load it here
+    # writer: pl.BackgroundWriter to save results and render figures while the next cell is analyzed, None to save them here
     
     print(f'Cell path: {path}/{filename}')
+    writer = pl.SerialWriter() if writer is None else writer
     
-    #%% Load data
+    #%% Load data and create mask from all localization data
     nFiles = len(fileIDs)
-    locData = dm.loadLocalizationData(path, filename, fileIDs)
+    if cell is None:
+        cell = loadCell(path, filename, fileIDs, dtype=dtype, useIndexCache=useIndexCache, sparseMask=sparseMask)
+    locData, cellMask = cell
 
     #%% Create subfolder for results
     results_path = os.path.join(path, 'results')
@@ -34,94 +44,256 @@ def performRipleysMultiAnalysis(path, filename, fileIDs, radii, nRandomControls=
         os.makedirs(results_path)
     
     #%% Mask
+    if saveFigures:
+        cellMask.plot()
+    writer.submit(cellMask.save, results_path, f'{filename}_mask')
 
-    ## Load mask from file
-    #cellMask = loadMask(path, "Cell_Mask.npy", pixelsize)
-    #cellMask.plot()
-
-    ## Create mask from all localization data
-    cellMask = mm.createMask(locData.allData, locData.pixelsize)
-    cellMask.plot()
-    cellMask.save(results_path, f'{filename}_mask')
 
+    #%% Local Ripley's functions of every localization
+    if localRipleys:
+        print('Computing local Ripleys functions...')
+        import h5py
+        with h5py.File(lm.getLocalFile(path, filename), 'w') as localFile:
+            for k in range(nFiles):
+                lm.computeLocalRipleys(locData.forest[k], radii, cellMask, output=localFile.create_group(f'Receptor_{fileIDs[k]}'), backend=backend)
+    
 
     #%% Perform Ripley's analysis for all data pairs
     ripleysResults = rm.initializeResultsMatrix(nFiles)
     ripleysIntegrals = np.zeros((nFiles,nFiles))
+    cellName = rs.getCellName(path, filename)
+    controlOptions = {'seed': seed, 'nWorkers': nWorkers, 'cache': cache, 'nullModel': nullModel, 'tolerance': tolerance, 'backend': backend, 'countThreads': countThreads,
+                      'histogramBinWidth': histogramBinWidth, 'subsampleSize': subsampleSize, 'targetError': targetError, 'timeBudget': timeBudget}
+    
+    # Neighbor counts of all receptor pairs in a single traversal, each unordered pair is counted once and shared by (j, k) and (k, j).
+    # The approximate mode counts a subsample per pair instead.
+    dataCounts = None
+    if subsampleSize is None:
+        print('Counting neighbors for all receptor pairs...')
+        with tr.span('counting.pairMatrix'):
+            dataCounts = countPairMatrix(locData.data, radii, cache, backend, countThreads, histogramBinWidth)
     
     for j in range(nFiles):
         for k in range(nFiles):
             print(f'Analyzing interaction between receptor {fileIDs[j]} and {fileIDs[k]}...')
-            if j==k:
-                ripleysResults[j][k] = rm.RipleysAnalysis(locData.forest[j], radii, cellMask, nRandomControls)
-            else:
-                ripleysResults[j][k] = rm.CrossRipleysAnalysis(locData.forest[j], locData.forest[k], radii, cellMask, nRandomControls)
+            with tr.span('analysis.pair', pair=f'{fileIDs[j]}_{fileIDs[k]}'):
+                if j==k:
+                    ripleysResults[j][k] = rm.RipleysAnalysis(locData.forest[j], radii, cellMask, nRandomControls,
+                                                              dataCounts=None if dataCounts is None else dataCounts[j,k], **controlOptions)
+                else:
+                    ripleysResults[j][k] = rm.CrossRipleysAnalysis(locData.forest[j], locData.forest[k], radii, cellMask, nRandomControls,
+                                                                   dataCounts=None if dataCounts is None else dataCounts[j,k], **controlOptions)
             ripleysIntegrals[j,k] = ripleysResults[j][k].ripleysIntegral_data
+            if resultStore is not None:
+                # Stream results to the store, curves and controls are not kept in memory
+                writer.submit(resultStore.writePair, cellName, fileIDs, j, k, rs.getPairResults(ripleysResults[j][k]))
+                ripleysResults[j][k] = None
     
-    # Normalized plot
-    figsize = 30
-    fig, axs = plt.subplots(nFiles, nFiles, figsize=(figsize, figsize))
-    for j in range(nFiles):
-        for k in range(nFiles):
-            ripleysResults[j][k].plot(ci=0.95, normalized=True, showControls=True,
-                                      title=f"Receptor {fileIDs[j]} with {fileIDs[k]}", labelFontsize=30, axes=axs[j][k])
-    fig.savefig(os.path.join(results_path, f'{filename}_ripleys_normalized'))
-    
-            
-    # Unnormalized plot
-    fig, axs = plt.subplots(nFiles, nFiles, figsize=(figsize, figsize))
-    for j in range(nFiles):
-        for k in range(nFiles):
-            ripleysResults[j][k].plot(ci=0.95, normalized=False, showControls=True,
-                                      title=f"Receptor {fileIDs[j]} with {fileIDs[k]}", labelFontsize=30, axes=axs[j][k])
-    fig.savefig(os.path.join(results_path, f'{filename}_ripleys_unnormalized'))
+    if saveFigures:
+        if resultStore is not None:
+            writer.submit(resultStore.saveCellFigures, cellName, results_path, filename, controlStyle=controlStyle, parallel=parallelFigures)
+        else:
+            pairResults = [[rs.getPairResults(ripleysResults[j][k]) for k in range(nFiles)] for j in range(nFiles)]
+            writer.submit(rs.saveReceptorMatrixFigures, pairResults, fileIDs, results_path, filename, controlStyle=controlStyle, parallel=parallelFigures)
     
     # Print and save integral matrix
     print(f'Integral matrix:\n{ripleysIntegrals}')
+    writer.submit(saveIntegrals, ripleysIntegrals, results_path, filename)
+    
+    return ripleysResults, ripleysIntegrals
+
+def loadCell(path, filename, fileIDs, dtype=np.float64, useIndexCache=True, sparseMask=False):
+    # Data, trees and mask of a cell, all I/O of the cell happens here (prefetched in a background thread by runAnalysis)
+    with tr.span('cell.load', cell=rs.getCellName(path, filename)):
+        indexCache = cm.SpatialIndexCache(cm.getIndexCachePath(path)) if useIndexCache else None
+        locData = dm.loadLocalizationData(path, filename, fileIDs, dtype=dtype, indexCache=indexCache)
+        locData.loadData()
+        locData.buildForest()
+
+        ## Load mask from file
+        #cellMask = loadMask(path, "Cell_Mask.npy", pixelsize)
+
+        cellMask = mm.createMask(locData.allData, locData.pixelsize, sparse=sparseMask)
+    return locData, cellMask
+
+def saveIntegrals(ripleysIntegrals, results_path, filename):
     integralfile = os.path.join(results_path, f'{filename}_ripleysIntegrals')
     np.save(integralfile, ripleysIntegrals)
     np.savetxt(integralfile+'.dat', ripleysIntegrals, delimiter='\t')
-
     print(f'Results saved in {results_path}\n')
-    
-    return ripleysResults, ripleysIntegrals
+
+def countPairMatrix(pointSets, radii, cache=None, backend='auto', countThreads=1, histogramBinWidth=None):
+    # Counted on the histogram grid and cached, so that other radii up to rmax need no recount
+    histogramRadii = cnt.getHistogramRadii(radii, histogramBinWidth)
+    histogramKey = cm.getHistogramKey(pointSets, histogramRadii) if cache is not None else None
+    histogram = cache.get(histogramKey) if cache is not None else None
+    if histogram is None:
+        histogram = {'counts': cnt.countPairMatrix(pointSets, histogramRadii, backend=backend, nThreads=countThreads)}
+        if cache is not None:
+            cache.put(histogramKey, histogram)
+    return cnt.resampleCumulative(histogram['counts'], histogramRadii, radii)
 
 def getIntegralConfidenceInterval(radii):
     lim = float(max(radii)-min(radii))
     return [-lim,lim] 
 
 
-#%% Set file paths and parameters
+#%% Configuration
 
-# NOTE: Change paths and filenames to the actual data, same file is taken multiple times here for demonstration purpose only
-cellPaths = ["./data/Cell3"]
-filenames = ['MutuDC_6h_stimuli']
-fileIDs = list(range(1,7))
+# Defaults of all parameters, a YAML file with any of these keys overrides them (see ripleysConfig.yaml)
+DEFAULT_CONFIG = {
+    # NOTE: Change paths and filenames to the actual data, same file is taken multiple times here for demonstration purpose only
+    'cellPaths': ["./data/Cell3"],
+    'filenames': ['MutuDC_6h_stimuli'],
+    'fileIDs': list(range(1,7)),
+    'nRandomControls': 100,
+    'nullModel': 'montecarlo', # 'montecarlo' for random controls, 'analytic' for the CSR expectation from the mask covariogram
+    'controlTolerance': None, # stop drawing controls once the envelope converged to this relative tolerance (nRandomControls is then the maximum), None for a fixed number
+    'seed': 0, # seed for random controls, results are identical for any number of workers
+    'nWorkers': 1, # parallel workers for random controls, None for all cores
+    'countThreads': 1, # threads counting neighbors of the data in spatial blocks (large cells), None for all cores
+    'subsampleSize': None, # approximate mode for exploratory runs of large cells: number of query points, 'auto' to choose it from targetError/timeBudget, None for exact counts
+    'targetError': 0.05, # relative standard error of K aimed for with subsampleSize='auto'
+    'timeBudget': None, # seconds of neighbor counting per receptor pair (data and controls) with subsampleSize='auto', None for no limit
+    'symmetricMatrix': False, # scheduler: one task per cross pair counts the data once for (j, k) and (k, j), controls are drawn for each direction (the driver always shares the data counts)
+    'histogramBinWidth': 1, # nm, neighbors are counted on this fine grid up to rmax and cached, other radii up to rmax need no recount; None to count at radii only
+    'controlCachePath': "./cache/controls", # random controls are reused across receptor pairs and reruns, None to disable
+    'controlCacheSize': 2*1024**3, # maximum size of the control cache on disk in bytes
+    'backend': 'auto', # pair counting backend: 'kdtree', 'celllist' (many points, small radii) or 'auto'
+    'localRipleys': False, # local L(r) of every localization against the CSR expectation, saved in results/<filename>_localRipleys.h5
+    'sparseMask': False, # run-length encoded mask for large fields of view, the field covers all localizations in any case
+    'dtype': 'float64', # storage of localization coordinates, 'float32' halves memory for large cells
+    'useIndexCache': True, # store coordinates and trees next to the data, rebuilt automatically when the data files change
+    'useScheduler': False, # run all (cell, receptor pair) tasks on a process pool with checkpoints, reruns skip completed tasks (no figures)
+    'nSchedulerWorkers': None, # processes for the scheduler, None for all cores
+    'prefetchCells': 1, # cells loaded (data, trees and mask) in a background thread while the current cell is analyzed, 0 to load each cell when its analysis starts
+    'backgroundWriter': True, # save results and render figures in a background thread while the analysis continues
+    'saveFigures': True, # False skips all figures, e.g. for batch runs
+    'controlStyle': 'collection', # random controls in figures: 'lines' (one line each, slow), 'collection' (single rasterized artist) or 'band' (range of controls)
+    'parallelFigures': True, # render normalized and unnormalized figures in two worker processes
+    'traceFile': None, # timed spans and counters of all stages, e.g. "./results/trace.json" (open in https://ui.perfetto.dev), None to disable
+    'resultStorePath': "./results/ripleysResults.h5", # curves, envelopes and integrals of all cells in one HDF5 file, None to keep results in memory
+    'rmax': 200,
+    'radii': None, # radii in nm, None for steps of 2 nm up to 80 nm and steps of 12 nm up to rmax
+    }
 
-nRandomControls = 100
-rmax = 200
-radii = np.concatenate((np.arange(4, 80, 2), np.arange(80, rmax+1, 12)))
+def loadConfig(file=None, **overrides):
+    # Default configuration, updated by the YAML file and then by the overrides
+    config = dict(DEFAULT_CONFIG)
+    if file is not None:
+        import yaml
+        with open(file) as f:
+            fileConfig = yaml.safe_load(f) or {}
+        unknownKeys = set(fileConfig) - set(DEFAULT_CONFIG)
+        if unknownKeys:
+            raise ValueError(f'Unknown configuration keys in {file}: {sorted(unknownKeys)}')
+        config.update(fileConfig)
+    config.update(overrides)
+    return config
 
+def getRadii(config):
+    if config['radii'] is not None:
+        return np.asarray(config['radii'], dtype=float)
+    rmax = config['rmax']
+    return np.concatenate((np.arange(4, 80, 2), np.arange(80, rmax+1, 12)))
 
-#%% Perform Ripleys analysis over multiple receptors for each cell
 
-allResults = []
-allIntegrals = []
-for path, filename in zip(cellPaths, filenames):
-    ripleysResults, ripleysIntegrals = performRipleysMultiAnalysis(path, filename, fileIDs, radii=radii, nRandomControls=nRandomControls)
-    allResults.append(ripleysResults)
-    allIntegrals.append(ripleysIntegrals)
+#%% Perform Ripleys analysis over multiple receptors for each cell
 
+def runAnalysis(config):
+    # Analysis of all cells, returns the integral matrix of every cell and their average
+    tstart = time.time()
+    radii = getRadii(config)
+    dtype = np.dtype(config['dtype']).type
+    analysisOptions = {name: config[name] for name in ('seed', 'nullModel', 'backend', 'useIndexCache', 'sparseMask', 'histogramBinWidth',
+                                                       'subsampleSize', 'targetError', 'timeBudget')}
+    traceFile = config['traceFile']
+    tracer = tr.enable() if traceFile is not None else None
+    try:
+        controlCachePath = config['controlCachePath']
+        controlCache = cm.ControlCache(controlCachePath, maxBytes=config['controlCacheSize']) if controlCachePath is not None else None
+        resultStore = rs.RipleysResultStore(config['resultStorePath']) if config['resultStorePath'] is not None else None
+        try:
+            allIntegrals, meanMatrix = analyzeCells(config, radii, dtype, controlCache, resultStore, analysisOptions)
+        finally:
+            # Also closed after an error, the driver may run inside a long-lived process
+            if resultStore is not None:
+                resultStore.close()
+    finally:
+        # The tracer of this run does not collect spans of later calls
+        if tracer is not None:
+            tr.disable()
+    
+    print(f'Average integral matrix of normalized Ripleys curves over all analyzed files:\n {meanMatrix}')
+    
+    #%% Confidence intervals for integrals
+    ci_integrals = getIntegralConfidenceInterval(radii)
+    print(f'Confidence interval for integral over normalized Ripleys curves:\n {ci_integrals}')
+    
+    #%% Runtime
+    elapsedTime = time.time() - tstart
+    print(f'Elapsed time for whole analysis: {elapsedTime:.3f} s')
+    if tracer is not None:
+        tracer.print()
+        tracer.save(traceFile)
+        print(f'Trace saved in {traceFile}')
+    return allIntegrals, meanMatrix
 
-#%% Average Ripleys matrices over all cells
-meanMatrix = np.mean( np.dstack(allIntegrals), axis=2)
-print(f'Average integral matrix of normalized Ripleys curves over all analyzed files:\n {meanMatrix}')
+def analyzeCells(config, radii, dtype, controlCache, resultStore, analysisOptions):
+    # Integral matrices of all cells and their average, with the scheduler or the pipelined driver
+    controlCachePath = config['controlCachePath']
+    if config['useScheduler']:
+        allIntegrals, meanMatrix = sch.runStudy(config['cellPaths'], config['filenames'], config['fileIDs'], radii, nRandomControls=config['nRandomControls'],
+                                                nWorkers=config['nSchedulerWorkers'], tolerance=config['controlTolerance'], dtype=dtype,
+                                                controlCachePath=controlCachePath, resultStore=resultStore,
+                                                symmetricMatrix=config['symmetricMatrix'], **analysisOptions)
+    else:
+        # Pipeline: the next cells are loaded and the results of previous cells are saved while the current cell is analyzed
+        allIntegrals = []
+        cells = list(zip(config['cellPaths'], config['filenames']))
+        loadOptions = {'fileIDs': config['fileIDs'], 'dtype': dtype, 'useIndexCache': config['useIndexCache'], 'sparseMask': config['sparseMask']}
+        cellData = pl.prefetch(lambda cell: loadCell(*cell, **loadOptions), cells, depth=config['prefetchCells'])
+        with pl.getWriter(config['backgroundWriter']) as writer:
+            for (path, filename), cell in zip(cells, cellData):
+                with tr.span('cell', cell=rs.getCellName(path, filename)):
+                    ripleysResults, ripleysIntegrals = performRipleysMultiAnalysis(path, filename, config['fileIDs'], radii=radii, nRandomControls=config['nRandomControls'],
+                                                                                     nWorkers=config['nWorkers'], cache=controlCache, tolerance=config['controlTolerance'],
+                                                                                     dtype=dtype, resultStore=resultStore, saveFigures=config['saveFigures'],
+                                                                                     controlStyle=config['controlStyle'], parallelFigures=config['parallelFigures'],
+                                                                                     localRipleys=config['localRipleys'], countThreads=config['countThreads'],
+                                                                                     cell=cell, writer=writer, **analysisOptions)
+                allIntegrals.append(ripleysIntegrals)
+                del ripleysResults, cell # released before the next cell is loaded
+        
+        #%% Average Ripleys matrices over all cells
+        meanMatrix = np.mean( np.dstack(allIntegrals), axis=2)
+    return allIntegrals, meanMatrix
 
-#%% Confidence intervals for integrals
-ci_integrals = getIntegralConfidenceInterval(radii)
-print(f'Confidence interval for integral over normalized Ripleys curves:\n {ci_integrals}')
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ripley's analysis of multiplexed single molecule localization data")
+    parser.add_argument('config', nargs='?', help='YAML configuration file, keys as in DEFAULT_CONFIG (defaults for missing keys)')
+    parser.add_argument('--cells', nargs='+', metavar='PATH', help='cell folders, overrides cellPaths')
+    parser.add_argument('--filenames', nargs='+', help='file name of each cell, overrides filenames')
+    parser.add_argument('--scheduler', action='store_true', help='run all tasks on the resumable scheduler')
+    parser.add_argument('--no-figures', action='store_true', help='skip all figures')
+    parser.add_argument('--trace', metavar='FILE', help='save a trace of all stages')
+    args = parser.parse_args(argv)
+    overrides = {}
+    if args.cells is not None:
+        overrides['cellPaths'] = args.cells
+    if args.filenames is not None:
+        overrides['filenames'] = args.filenames
+    if args.scheduler:
+        overrides['useScheduler'] = True
+    if args.no_figures:
+        overrides['saveFigures'] = False
+    if args.trace is not None:
+        overrides['traceFile'] = args.trace
+    config = loadConfig(args.config, **overrides)
+    if len(config['cellPaths']) != len(config['filenames']):
+        parser.error('Number of cell paths and filenames differ.')
+    return runAnalysis(config)
 
 
-#%% Runtime
-elapsedTime = time.time() - tstart
-print(f'Elapsed time for whole analysis: {elapsedTime:.3f} s')
+if __name__ == "__main__":
+    main()
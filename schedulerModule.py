@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Mar 19 15:47:02 2023
+
+@author: Magdalena Schneider, Janelia Research Campus
+
+Resumable scheduler for Ripley's analysis of many cells: every (cell, receptor pair) is a task,
+tasks run on a process pool and each finished task is checkpointed
+"""
+
+import os
+import json
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import dataModule as dm
+import maskModule as mm
+import ripleysModule as rm
+import cacheModule as cm
+import resultsModule as rs
+
+PairTask = namedtuple('PairTask', ['cellIndex', 'path', 'filename', 'fileIDs', 'j', 'k'])
+
+_cellData = {} # localization data and mask of the last cell loaded in this process
+
+
+def runStudy(cellPaths, filenames, fileIDs, radii, nRandomControls=100, nWorkers=None, resultStore=None, symmetricMatrix=False, **analysisOptions):
+    # Runs all (cell, receptor pair) tasks that have no checkpoint yet and aggregates the integral matrices from the checkpoints.
+    # Finished pairs are also written to the RipleysResultStore, if given.
+    # With symmetricMatrix, only pairs j <= k are tasks, a cross pair task counts the data once and analyzes both directions
+    # (each direction with its own controls, as the null model randomizes the first receptor).
+    # analysisOptions: seed, nullModel, tolerance, backend, dtype, useIndexCache, controlCachePath, sparseMask, histogramBinWidth,
+    # subsampleSize, targetError, timeBudget
+    from tqdm import tqdm
+    config = dict(analysisOptions, radii=np.asarray(radii, dtype=float).tolist(), nRandomControls=nRandomControls)
+    configKey = getConfigKey(config)
+    tasks = getStudyTasks(cellPaths, filenames, fileIDs, symmetricMatrix)
+    openTasks = [task for task in tasks if not all(os.path.exists(getCheckpointFile(pair, configKey)) for pair in getTaskPairs(task, symmetricMatrix))]
+    print(f'{len(tasks) - len(openTasks)} of {len(tasks)} tasks already completed')
+
+    if openTasks:
+        with ProcessPoolExecutor(max_workers=nWorkers) as pool:
+            # Each task is submitted separately, so idle workers pick up the next open task
+            futures = [pool.submit(runPairTask, task, config, symmetricMatrix) for task in openTasks]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                for pair, pairResults in future.result().items():
+                    saveCheckpoint(getCheckpointFile(pair, configKey), pairResults)
+                    if resultStore is not None:
+                        storePairResults(resultStore, pair, pairResults)
+    
+    if resultStore is not None:
+        # Pairs completed in previous runs
+        for task in tasks:
+            for pair in getTaskPairs(task, symmetricMatrix):
+                if not resultStore.hasPair(rs.getCellName(pair.path, pair.filename), pair.fileIDs, pair.j, pair.k):
+                    storePairResults(resultStore, pair, loadCheckpoint(getCheckpointFile(pair, configKey)))
+
+    allIntegrals = [aggregateIntegrals(tasks, cellIndex, configKey, symmetricMatrix) for cellIndex in range(len(cellPaths))]
+    for path, filename, ripleysIntegrals in zip(cellPaths, filenames, allIntegrals):
+        results_path = os.path.join(path, 'results')
+        if not os.path.exists(results_path):
+            os.makedirs(results_path)
+        integralfile = os.path.join(results_path, f'{filename}_ripleysIntegrals')
+        np.save(integralfile, ripleysIntegrals)
+        np.savetxt(integralfile+'.dat', ripleysIntegrals, delimiter='\t')
+    meanMatrix = np.mean(np.dstack(allIntegrals), axis=2)
+    return allIntegrals, meanMatrix
+
+def getStudyTasks(cellPaths, filenames, fileIDs, symmetricMatrix=False):
+    tasks = []
+    for cellIndex, (path, filename) in enumerate(zip(cellPaths, filenames)):
+        for j in range(len(fileIDs)):
+            for k in range(j if symmetricMatrix else 0, len(fileIDs)):
+                tasks.append(PairTask(cellIndex, path, filename, tuple(fileIDs), j, k))
+    return tasks
+
+def getTaskPairs(task, symmetricMatrix=False):
+    # Ordered receptor pairs analyzed by a task, both directions for a cross pair in symmetric mode
+    if symmetricMatrix and (task.j != task.k):
+        return [task, task._replace(j=task.k, k=task.j)]
+    return [task]
+
+def runPairTask(task, config, symmetricMatrix=False):
+    # Pair results of every ordered pair of the task (see getTaskPairs)
+    locData, cellMask = loadCell(task, config)
+    options = {'seed': config.get('seed', 0), 'nullModel': config.get('nullModel', 'montecarlo'),
+               'tolerance': config.get('tolerance'), 'backend': config.get('backend', 'auto'),
+               'histogramBinWidth': config.get('histogramBinWidth'), 'subsampleSize': config.get('subsampleSize'),
+               'targetError': config.get('targetError', 0.05), 'timeBudget': config.get('timeBudget')}
+    if config.get('controlCachePath') is not None:
+        options['cache'] = cm.ControlCache(config['controlCachePath'])
+    radii = np.asarray(config['radii'])
+    nControls = config['nRandomControls']
+    if task.j == task.k:
+        return {task: rs.getPairResults(rm.RipleysAnalysis(locData.forest[task.j], radii, cellMask, nControls, **options))}
+    pairs = getTaskPairs(task, symmetricMatrix)
+    dataCounts = None
+    if (len(pairs) > 1) and (options['subsampleSize'] is None):
+        # Data counts of (j, k) are those of (k, j), only the controls differ
+        dataCounts = rm.RipleysInterface(radii, cellMask, nControls, **options).getDataCounts(locData.forest[task.j], locData.forest[task.k])
+    return {pair: rs.getPairResults(rm.CrossRipleysAnalysis(locData.forest[pair.j], locData.forest[pair.k], radii, cellMask, nControls,
+                                                            dataCounts=dataCounts, **options))
+            for pair in pairs}
+
+def storePairResults(resultStore, task, pairResults):
+    resultStore.writePair(rs.getCellName(task.path, task.filename), task.fileIDs, task.j, task.k, pairResults)
+
+def loadCell(task, config):
+    # Tasks of the same cell mostly run after each other, so only the last cell is kept per process
+    key = (task.path, task.filename, task.fileIDs)
+    if key not in _cellData:
+        _cellData.clear()
+        indexCache = cm.SpatialIndexCache(cm.getIndexCachePath(task.path)) if config.get('useIndexCache', True) else None
+        locData = dm.loadLocalizationData(task.path, task.filename, list(task.fileIDs),
+                                          dtype=config.get('dtype', np.float64), indexCache=indexCache)
+        cellMask = mm.createMask(locData.allData, locData.pixelsize, sparse=config.get('sparseMask', False))
+        _cellData[key] = (locData, cellMask)
+    return _cellData[key]
+
+
+#%% Checkpoints
+
+def getConfigKey(config):
+    # Checkpoints of different radii, number of controls or options are kept apart
+    configString = json.dumps({name: str(value) for name, value in config.items() if name != 'controlCachePath'}, sort_keys=True)
+    return hashlib.sha256(configString.encode()).hexdigest()[:16]
+
+def getCheckpointFile(task, configKey):
+    folder = os.path.join(task.path, 'results', 'checkpoints', configKey)
+    return os.path.join(folder, f'{task.filename}_{task.fileIDs[task.j]}_{task.fileIDs[task.k]}.npz')
+
+def saveCheckpoint(file, pairResults):
+    folder = os.path.dirname(file)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    cm.writeAtomic(file, lambda f: np.savez(f, **pairResults))
+
+def loadCheckpoint(file):
+    with np.load(file) as npz:
+        return {name: npz[name] for name in npz.files}
+
+def aggregateIntegrals(tasks, cellIndex, configKey, symmetricMatrix=False):
+    cellTasks = [task for task in tasks if task.cellIndex == cellIndex]
+    nFiles = len(cellTasks[0].fileIDs)
+    ripleysIntegrals = np.zeros((nFiles, nFiles))
+    for task in cellTasks:
+        for pair in getTaskPairs(task, symmetricMatrix):
+            ripleysIntegrals[pair.j, pair.k] = loadCheckpoint(getCheckpointFile(pair, configKey))['integral']
+    return ripleysIntegrals
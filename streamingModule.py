@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Mar  4 11:18:27 2023
+
+@author: Magdalena Schneider, Janelia Research Campus
+
+Streaming accumulators for random control curves with memory independent of the number of controls
+"""
+
+import numpy as np
+
+
+class P2Quantile:
+    # P-square quantile estimator (Jain & Chlamtac, 1985), vectorized over all radii.
+    # Observations are kept exactly until the buffer is full, then five markers per radius are updated.
+    def __init__(self, quantile, bufferSize=1000):
+        assert bufferSize >= 5, "Buffer size has to be at least 5"
+        self.quantile = quantile
+        self.bufferSize = bufferSize
+        self.buffer = []
+        self.heights = None # marker heights, shape (5, nRadii)
+        self.positions = None # actual marker positions (1-based), shape (5, nRadii)
+        self.desired = None # desired marker positions, shape (5,)
+        self.increments = np.array([0, quantile/2, quantile, (1+quantile)/2, 1])
+
+    def add(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.heights is None:
+            self.buffer.append(x)
+            if len(self.buffer) == self.bufferSize:
+                self.initializeMarkers()
+            return
+        self.update(x)
+
+    def initializeMarkers(self):
+        values = np.sort(np.array(self.buffer), axis=0)
+        nValues = len(values)
+        self.desired = 1 + (nValues-1) * self.increments
+        markerIndex = np.round(self.desired).astype(int) - 1
+        self.heights = values[markerIndex]
+        self.positions = np.repeat((markerIndex + 1)[:, None], values.shape[1], axis=1).astype(float)
+        self.buffer = []
+
+    def update(self, x):
+        q, n = self.heights, self.positions
+        # Cell of the new observation, extreme markers are moved if needed
+        q[0] = np.minimum(q[0], x)
+        q[4] = np.maximum(q[4], x)
+        k = np.sum(x[None, :] >= q[1:4], axis=0)
+        n += (np.arange(5)[:, None] > k[None, :])
+        self.desired += self.increments
+
+        # Adjust inner markers with piecewise parabolic prediction
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            move = ((d >= 1) & (n[i+1] - n[i] > 1)) | ((d <= -1) & (n[i-1] - n[i] < -1))
+            if not move.any():
+                continue
+            d = np.sign(d)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                parabolic = q[i] + d / (n[i+1] - n[i-1]) * ((n[i] - n[i-1] + d) * (q[i+1] - q[i]) / (n[i+1] - n[i])
+                                                          + (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / (n[i] - n[i-1]))
+                neighbor = np.where(d > 0, i+1, i-1)
+                qNeighbor = np.take_along_axis(q, neighbor[None, :], axis=0)[0]
+                nNeighbor = np.take_along_axis(n, neighbor[None, :], axis=0)[0]
+                linear = q[i] + d * (qNeighbor - q[i]) / (nNeighbor - n[i])
+            height = np.where((q[i-1] < parabolic) & (parabolic < q[i+1]), parabolic, linear)
+            q[i] = np.where(move, height, q[i])
+            n[i] = np.where(move, n[i] + d, n[i])
+
+    def getValue(self):
+        if self.heights is None:
+            return np.quantile(np.array(self.buffer), self.quantile, axis=0) # exact while buffered
+        return self.heights[2].copy()
+
+
+class ControlAccumulator:
+    # Running mean, standard deviation and quantiles of control curves
+    def __init__(self, quantiles, bufferSize=1000):
+        self.quantileLevels = np.asarray(quantiles, dtype=float)
+        self.estimators = [P2Quantile(quantile, bufferSize) for quantile in self.quantileLevels]
+        self.count = 0
+        self.sum = 0
+        self.sumSquares = 0
+
+    def add(self, K):
+        # K of shape (nRadii,) or a batch of shape (nCurves, nRadii), added in order
+        for curve in np.atleast_2d(K):
+            self.count += 1
+            self.sum = self.sum + curve
+            self.sumSquares = self.sumSquares + curve**2
+            for estimator in self.estimators:
+                estimator.add(curve)
+
+    def getMean(self):
+        return self.sum / self.count
+
+    def getStd(self):
+        variance = self.sumSquares / self.count - self.getMean()**2
+        return np.sqrt(np.clip(variance, 0, None))
+
+    def getQuantiles(self):
+        return np.array([estimator.getValue() for estimator in self.estimators])
+
+    def getControlCurves(self):
+        return {'mean': self.getMean(), 'std': self.getStd(), 'quantiles': self.getQuantiles(),
+                'quantileLevels': self.quantileLevels, 'nControls': np.array(self.count)}
+
+
+#%% Helper functions
+
+def getEnvelopeChange(quantiles, previousQuantiles, mean):
+    # Largest change of any envelope bound, relative to its distance from the mean
+    scale = np.abs(quantiles - mean)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = np.abs(quantiles - previousQuantiles) / scale
+    change[(scale == 0) & (quantiles == previousQuantiles)] = 0
+    return np.max(change)
+
+def getQuantileLevels(ciLevels):
+    quantiles = []
+    for ci in ciLevels:
+        quantiles += [(1-ci)/2, 1 - (1-ci)/2]
+    return quantiles
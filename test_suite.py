@@ -5,11 +5,32 @@ Created on Sat Nov 12 10:41:53 2022
 @author: Magdalena Schneider, Janelia Research Campus
 """
 
+import os
+import sys
+import glob
+import json
+import subprocess
+import multiprocessing
 import unittest
+import tempfile
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
+import h5py
 import numpy as np
+from scipy.spatial import KDTree
 import dataModule as dm
 import maskModule as mm
 import ripleysModule as rm
+import cacheModule as cm
+import countingModule as cnt
+import streamingModule as sm
+import schedulerModule as sch
+import resultsModule as rs
+import benchmarkModule as bm
+import traceModule as tr
+import localModule as lm
+import pipelineModule as pl
+import run_ripleysAnalysis as ra
 
 np.random.seed(10) # initialize random seed
 
@@ -86,5 +107,534 @@ class TestRandomDistribution(unittest.TestCase):
         results.plot(ci=0.95, normalized=True, showControls=True, title='Cross Ripleys (normalized)')
         results.plot(ci=0.95, normalized=False, showControls=True, title='Cross Ripleys')
 
+
+def writeSyntheticLocalizations(path, filename, fileIDs, nLocs=100, seed=0):
+    # Receptor files in the format written by picasso
+    rng = np.random.default_rng(seed)
+    with open(os.path.join(path, f'{filename}_multi.yaml'), 'w') as f:
+        f.write('Pixelsize: 130\n')
+    allLocs = []
+    for k in fileIDs:
+        locs = np.zeros(nLocs*k, dtype=[('frame', 'u4'), ('x', 'f4'), ('y', 'f4'), ('photons', 'f4')])
+        locs['x'], locs['y'] = rng.uniform(0, 512, size=(2, nLocs*k))
+        with h5py.File(os.path.join(path, f'{filename}_Receptor_{k}.hdf5'), 'w') as f:
+            f.create_dataset('locs', data=locs)
+        allLocs.append(locs)
+    return allLocs
+
+def syntheticMask(nPixels=64, pixelsize=130):
+    y, x = np.mgrid[0:nPixels, 0:nPixels]
+    center = (nPixels - 1) / 2
+    maskData = ((x - center)**2 + (y - center)**2) <= (0.4*nPixels)**2
+    return mm.Mask(maskData, pixelsize)
+
+
+class TestSyntheticData(unittest.TestCase):
+    
+    def test_randomPoints_exactCount(self):
+        cellMask = syntheticMask()
+        points = cellMask.randomPointsBatch(3, 1000, rng=np.random.default_rng(0))
+        self.assertEqual(points.shape, (3, 1000, 2))
+        pixels = np.floor(points / cellMask.pixelsize).astype(int)
+        self.assertTrue(cellMask.mask[pixels[...,1], pixels[...,0]].all())
+        
+        rngs = [np.random.default_rng(seed) for seed in range(3)]
+        single, nFactor = cellMask.randomPoints(1000, rng=np.random.default_rng(1))
+        self.assertEqual(nFactor, 1.0)
+        np.testing.assert_array_equal(cellMask.randomPointsBatch(3, 1000, rng=rngs)[1], single)
+    
+    def test_loadLocalizationData(self):
+        with tempfile.TemporaryDirectory() as path:
+            allLocs = writeSyntheticLocalizations(path, 'synthetic', [1, 2])
+            locData = dm.loadLocalizationData(path, 'synthetic', [1, 2], dtype=np.float32)
+            self.assertFalse(locData.data.isLoaded(0))
+            self.assertEqual(locData.forest[1].n, 200)
+            self.assertFalse(locData.data.isLoaded(0))
+            self.assertEqual(locData.data[0].dtype, np.float32)
+            self.assertTrue(locData.data[0].flags['C_CONTIGUOUS'])
+            np.testing.assert_allclose(locData.allData[:,0], np.concatenate([locs['x'] for locs in allLocs]) * 130, rtol=1e-6)
+    
+    def test_spatialIndexCache(self):
+        with tempfile.TemporaryDirectory() as path:
+            writeSyntheticLocalizations(path, 'synthetic', [1, 2])
+            indexCache = cm.SpatialIndexCache(cm.getIndexCachePath(path))
+            first = dm.loadLocalizationData(path, 'synthetic', [1, 2], indexCache=indexCache)
+            first.buildForest()
+            second = dm.loadLocalizationData(path, 'synthetic', [1, 2], indexCache=indexCache)
+            self.assertIsInstance(second.data[0], np.memmap)
+            np.testing.assert_array_equal(second.forest[1].data, first.forest[1].data)
+            np.testing.assert_array_equal(second.forest[1].indices, first.forest[1].indices)
+            
+            # Changed source file invalidates the cache
+            writeSyntheticLocalizations(path, 'synthetic', [1], nLocs=150, seed=1)
+            third = dm.loadLocalizationData(path, 'synthetic', [1, 2], indexCache=indexCache)
+            self.assertEqual(len(third.data[0]), 150)
+            self.assertEqual(third.forest[0].n, 150)
+            
+            # Trees pickled by another scipy version or not unpicklable anymore are rebuilt
+            file = third.getReceptorFile(0)
+            with mock.patch('scipy.__version__', '0.0'):
+                self.assertIsNone(indexCache.loadTree(file, third.pixelsize, np.float64))
+            treeFile = os.path.join(indexCache.path, f'{indexCache.getName(file, np.float64)}.kdtree.pkl')
+            with open(treeFile, 'wb') as f:
+                f.write(b'cremovedModule\nTree\n.')
+            self.assertIsNone(indexCache.loadTree(file, third.pixelsize, np.float64))
+            self.assertEqual(dm.loadLocalizationData(path, 'synthetic', [1, 2], indexCache=indexCache).forest[0].n, 150)
+    
+    def test_resumableScheduler(self):
+        radii = np.arange(200, 2000, 300)
+        with tempfile.TemporaryDirectory() as path:
+            cellPaths = [os.path.join(path, 'Cell1'), os.path.join(path, 'Cell2')]
+            for seed, cellPath in enumerate(cellPaths):
+                os.makedirs(cellPath)
+                writeSyntheticLocalizations(cellPath, 'synthetic', [1, 2], seed=seed)
+            filenames = ['synthetic', 'synthetic']
+            allIntegrals, meanMatrix = sch.runStudy(cellPaths, filenames, [1, 2], radii, nRandomControls=5, nWorkers=2, seed=0)
+            tasks = sch.getStudyTasks(cellPaths, filenames, [1, 2])
+            self.assertEqual(len(tasks), 8)
+            
+            # Remove one checkpoint, only this task is run again
+            configKey = sch.getConfigKey(dict(seed=0, radii=radii.astype(float).tolist(), nRandomControls=5))
+            os.remove(sch.getCheckpointFile(tasks[1], configKey))
+            rerunIntegrals, rerunMean = sch.runStudy(cellPaths, filenames, [1, 2], radii, nRandomControls=5, nWorkers=1, seed=0)
+            np.testing.assert_array_equal(rerunMean, meanMatrix)
+            
+            locData = dm.loadLocalizationData(cellPaths[0], 'synthetic', [1, 2])
+            cellMask = mm.createMask(locData.allData, locData.pixelsize)
+            results = rm.CrossRipleysAnalysis(locData.forest[0], locData.forest[1], radii, cellMask, 5, seed=0)
+            self.assertEqual(allIntegrals[0][0, 1], results.ripleysIntegral_data)
+    
+    def test_controls_independentOfWorkers(self):
+        cellMask = syntheticMask()
+        points, *__ = cellMask.randomPoints(500, rng=np.random.default_rng(1))
+        radii = np.arange(10, 200, 20)
+        
+        serial = rm.RipleysAnalysis(points, radii, cellMask, nControls=8, seed=3, nWorkers=1)
+        threaded = rm.RipleysAnalysis(points, radii, cellMask, nControls=8, seed=3, nWorkers=2, executor='thread')
+        parallel = rm.RipleysAnalysis(points, radii, cellMask, nControls=8, seed=3, nWorkers=2)
+        for results in (threaded, parallel):
+            np.testing.assert_array_equal(serial.ripleysCurves_controls['K'], results.ripleysCurves_controls['K'])
+            self.assertEqual(serial.ripleysIntegral_data, results.ripleysIntegral_data)
+    
+    def test_labeledPairCounts(self):
+        rng = np.random.default_rng(0)
+        pointSets = [rng.uniform(0, 5000, size=(n, 2)) for n in (400, 600, 200)]
+        radii = np.arange(10, 300, 15)
+        counts = cnt.countPairMatrix(pointSets, radii, chunkSize=256)
+        for j, pointsA in enumerate(pointSets):
+            for k, pointsB in enumerate(pointSets):
+                expected = KDTree(pointsA).count_neighbors(KDTree(pointsB), radii) - (len(pointsA) if j==k else 0)
+                np.testing.assert_array_equal(counts[j,k], expected)
+        
+        controls = rng.uniform(0, 5000, size=(5, 300, 2))
+        controlCounts = cnt.countControlBatch(controls, radii)
+        for points, counts in zip(controls, controlCounts):
+            np.testing.assert_array_equal(counts, KDTree(points).count_neighbors(KDTree(points), radii) - len(points))
+    
+    def test_envelopeNormalization(self):
+        cellMask = syntheticMask()
+        points, *__ = cellMask.randomPoints(500, rng=np.random.default_rng(1))
+        radii = np.arange(50, 300, 25)
+        results = rm.RipleysAnalysis(points, radii, cellMask, nControls=20, seed=3)
+        envelope = results.getEnvelope(0.9)
+        self.assertIs(envelope, results.getEnvelope(0.9))
+        np.testing.assert_array_equal(envelope.high, np.quantile(results.ripleysCurves_controls['K'], 0.95, axis=0))
+        
+        controlsNormalized = results.normalizeCurve(results.ripleysCurves_controls['K'], ci=0.9)
+        for K, KNormalized in zip(results.ripleysCurves_controls['K'], controlsNormalized):
+            np.testing.assert_array_equal(results.normalizeCurve(K, ci=0.9), KNormalized)
+        self.assertTrue((np.abs(controlsNormalized) <= 1).mean() >= 0.85)
+    
+    def test_streamingControls(self):
+        cellMask = syntheticMask()
+        points, *__ = cellMask.randomPoints(500, rng=np.random.default_rng(1))
+        radii = np.arange(50, 300, 25)
+        full = rm.RipleysAnalysis(points, radii, cellMask, nControls=50, seed=3)
+        streaming = rm.RipleysAnalysis(points, radii, cellMask, nControls=50, seed=3, streaming=True)
+        self.assertNotIn('K', streaming.ripleysCurves_controls)
+        np.testing.assert_allclose(streaming.getRipleysMean(), full.getRipleysMean())
+        np.testing.assert_array_equal(streaming.getEnvelope().low, full.getEnvelope().low)
+        
+        adaptive = rm.RipleysAnalysis(points, radii, cellMask, nControls=2000, seed=3, tolerance=0.2, adaptiveStep=50)
+        self.assertLess(adaptive.nControlsUsed, 2000)
+        self.assertEqual(adaptive.nControlsUsed % 50, 0)
+        
+        accumulator = sm.ControlAccumulator([0.1, 0.9], bufferSize=20)
+        values = np.random.default_rng(0).normal(size=(5000, 3))
+        accumulator.add(values)
+        np.testing.assert_allclose(accumulator.getQuantiles(), np.quantile(values, [0.1, 0.9], axis=0), atol=0.05)
+    
+    def test_analyticNullModel(self):
+        cellMask = syntheticMask(nPixels=128)
+        points, *__ = cellMask.randomPoints(2000, rng=np.random.default_rng(1))
+        otherPoints, *__ = cellMask.randomPoints(1000, rng=np.random.default_rng(2))
+        radii = np.arange(50, 400, 50)
+        for otherData in (None, otherPoints):
+            if otherData is None:
+                montecarlo = rm.RipleysAnalysis(points, radii, cellMask, nControls=100, seed=3)
+                analytic = rm.RipleysAnalysis(points, radii, cellMask, nControls=100, seed=3, nullModel='analytic')
+            else:
+                montecarlo = rm.CrossRipleysAnalysis(points, otherData, radii, cellMask, nControls=100, seed=3)
+                analytic = rm.CrossRipleysAnalysis(points, otherData, radii, cellMask, nControls=100, seed=3, nullModel='analytic')
+            np.testing.assert_allclose(analytic.getRipleysMean(), montecarlo.getRipleysMean(), rtol=0.03)
+            np.testing.assert_allclose(analytic.ripleysCurves_controls['std'], montecarlo.ripleysCurves_controls['K'].std(axis=0), rtol=0.25)
+    
+    def test_cellListBackend(self):
+        rng = np.random.default_rng(0)
+        points = rng.uniform(0, 5000, size=(2000, 2))
+        otherPoints = np.vstack([points[:100], rng.uniform(-100, 5100, size=(1500, 2))]) # includes duplicates and points outside
+        radii = np.arange(4, 200, 6)
+        for backend in ('kdtree', 'celllist'):
+            self.assertEqual(cnt.getBackend(backend).name, backend)
+        kdtree, celllist = cnt.BACKENDS['kdtree'], cnt.BACKENDS['celllist']
+        np.testing.assert_array_equal(kdtree.countNeighbors(points, None, radii), celllist.countNeighbors(points, None, radii))
+        np.testing.assert_array_equal(kdtree.countNeighbors(points, otherPoints, radii), celllist.countNeighbors(points, otherPoints, radii))
+        np.testing.assert_array_equal(cnt.countPairMatrix([points, otherPoints], radii, backend='kdtree'),
+                                      cnt.countPairMatrix([points, otherPoints], radii, backend='celllist'))
+        self.assertEqual(cnt.selectBackend(10**5, 200, 66560), 'celllist')
+        self.assertEqual(cnt.selectBackend(10**7, 200, 66560), 'kdtree')
+        
+        # Cell lists are cached like their points
+        self.assertEqual(cm.fingerprintPoints(rm.getTree(otherPoints, 'celllist', 200)), cm.fingerprintPoints(otherPoints))
+        cellMask = syntheticMask()
+        points, *__ = cellMask.randomPoints(200, rng=np.random.default_rng(1))
+        otherPoints, *__ = cellMask.randomPoints(200, rng=np.random.default_rng(2))
+        results = rm.CrossRipleysAnalysis(points, rm.getTree(otherPoints, 'celllist', 400), np.arange(100, 400, 100), cellMask, 5, seed=1, cache=cm.ControlCache(None))
+        self.assertEqual(results.nControlsUsed, 5)
+    
+    def test_controlCache(self):
+        cellMask = syntheticMask()
+        points, *__ = cellMask.randomPoints(500, rng=np.random.default_rng(1))
+        otherPoints, *__ = cellMask.randomPoints(300, rng=np.random.default_rng(2))
+        radii = np.arange(10, 200, 20)
+        with tempfile.TemporaryDirectory() as path:
+            first = rm.CrossRipleysAnalysis(points, otherPoints, radii, cellMask, nControls=4, seed=3,
+                                            cache=cm.ControlCache(path))
+            # new cache object, so the controls have to come from disk
+            cache = cm.ControlCache(path)
+            second = rm.CrossRipleysAnalysis(points, otherPoints, radii, cellMask, nControls=4, seed=3, cache=cache)
+            self.assertEqual(len(cache.memory), 1)
+            np.testing.assert_array_equal(first.ripleysCurves_controls['K'], second.ripleysCurves_controls['K'])
+            
+            other = rm.CrossRipleysAnalysis(points, otherPoints[:-1], radii, cellMask, nControls=4, seed=3, cache=cache)
+            self.assertEqual(len(cache.memory), 2)
+            self.assertFalse(np.array_equal(first.ripleysCurves_controls['K'], other.ripleysCurves_controls['K']))
+            
+            # Files evicted by another process between listing and eviction are skipped
+            files = glob.glob(os.path.join(path, '*.npz'))
+            with mock.patch('glob.glob', return_value=files + [os.path.join(path, 'evicted.npz')]):
+                cm.ControlCache(path, maxBytes=0).evict()
+            self.assertEqual(os.listdir(path), [])
+            
+            # Entries evicted by another process between reading and marking them as used are still returned
+            cache = cm.ControlCache(path)
+            cache.put('entry', {'K': np.ones(3)})
+            cache.memory.clear()
+            with mock.patch('os.utime', side_effect=FileNotFoundError):
+                np.testing.assert_array_equal(cache.get('entry')['K'], np.ones(3))
+
+
+    def test_resultStore(self):
+        cellMask = syntheticMask()
+        points, *__ = cellMask.randomPoints(500, rng=np.random.default_rng(1))
+        otherPoints, *__ = cellMask.randomPoints(300, rng=np.random.default_rng(2))
+        radii = np.arange(10, 200, 20)
+        results = rm.CrossRipleysAnalysis(points, otherPoints, radii, cellMask, nControls=6, seed=3)
+        with tempfile.TemporaryDirectory() as path:
+            file = os.path.join(path, 'results.h5')
+            with rs.RipleysResultStore(file) as store:
+                store.writePair('Cell1_synthetic', [1, 2], 0, 1, rs.getPairResults(results))
+            
+            # Reopened store, results are read without the analysis object
+            with rs.RipleysResultStore(file, mode='r') as store:
+                self.assertEqual(store.getCells(), ['Cell1_synthetic'])
+                integrals = store.getIntegrals('Cell1_synthetic')
+                self.assertIsInstance(integrals, np.memmap)
+                self.assertEqual(integrals[0, 1], results.ripleysIntegral_data)
+                self.assertTrue(np.isnan(integrals[1, 0]))
+                pair = store.getPair('Cell1_synthetic', 0, 1)
+                np.testing.assert_array_equal(pair['dataNormalized'], results.ripleysCurves_data['normalized'])
+                np.testing.assert_array_equal(pair['controlsK'][2:4], results.ripleysCurves_controls['K'][2:4])
+                np.testing.assert_array_equal(pair['envelopeHigh'], results.getEnvelope(0.95).high)
+                store.plotPair('Cell1_synthetic', 0, 1, showControls=True)
+        
+        # Cells of different folders with the same folder and file name are stored apart
+        self.assertNotEqual(rs.getCellName('./day1/Cell1', 'synthetic'), rs.getCellName('./day2/Cell1', 'synthetic'))
+        self.assertEqual(rs.getCellName('./day1/Cell1/', 'synthetic'), rs.getCellName(os.path.abspath('day1/Cell1'), 'synthetic'))
+        self.assertTrue(rs.getCellName('./day1/Cell1', 'synthetic').startswith('Cell1_synthetic_'))
+
+    def test_fastFigures(self):
+        cellMask = syntheticMask()
+        points, *__ = cellMask.randomPoints(500, rng=np.random.default_rng(1))
+        radii = np.arange(10, 200, 20)
+        results = rm.RipleysAnalysis(points, radii, cellMask, nControls=6, seed=3)
+        pairResults = [[rs.getPairResults(results)]]
+        with tempfile.TemporaryDirectory() as path:
+            # Figure workers are not forked from this process, whose other threads may hold locks
+            self.assertNotEqual(rm.getProcessContext().get_start_method(), 'fork')
+            rs.saveReceptorMatrixFigures(pairResults, [1], path, 'collection', controlStyle='collection', parallel=True)
+            rs.saveReceptorMatrixFigures(pairResults, [1], path, 'band', controlStyle='band', parallel=False)
+            self.assertEqual(sorted(os.listdir(path)), ['band_ripleys_normalized.png', 'band_ripleys_unnormalized.png',
+                                                        'collection_ripleys_normalized.png', 'collection_ripleys_unnormalized.png'])
+        with self.assertRaises(ValueError):
+            results.plot(showControls=True, controlStyle='dots')
+
+    def test_benchmarks(self):
+        benchmarks = bm.runBenchmarks(patterns=('cocluster',), sizes=(500,), stages=('randomPoints', 'normalizeCurve'),
+                                      nControls=4, repeats=1, nPixels=64)
+        self.assertEqual([result['stage'] for result in benchmarks['results']], ['randomPoints', 'normalizeCurve'])
+        with tempfile.TemporaryDirectory() as path:
+            file = os.path.join(path, 'benchmark.json')
+            bm.saveBenchmarks(file, benchmarks)
+            baseline = bm.loadBenchmarks(file)
+        self.assertEqual(bm.compareBenchmarks(benchmarks, baseline), [])
+        
+        # Baseline with half the memory, flagged as regression
+        for result in baseline['results']:
+            result['peakMemory'] /= 2
+        regressions = bm.compareBenchmarks(benchmarks, baseline)
+        self.assertEqual({regression['metric'] for regression in regressions}, {'peakMemory'})
+
+    def test_tracing(self):
+        with tempfile.TemporaryDirectory() as path:
+            writeSyntheticLocalizations(path, 'synthetic', [1, 2])
+            tracer = tr.enable()
+            try:
+                locData = dm.loadLocalizationData(path, 'synthetic', [1, 2])
+                cellMask = mm.createMask(locData.allData, locData.pixelsize)
+                rm.CrossRipleysAnalysis(locData.forest[0], locData.forest[1], np.arange(200, 2000, 300), cellMask, nControls=3, seed=0)
+            finally:
+                tr.disable()
+            self.assertFalse(tr.isEnabled())
+            summary = tracer.getSummary()
+            for name in ['load.receptor', 'mask.create', 'index.buildTree', 'controls', 'controls.batch', 'counting.data']:
+                self.assertIn(name, summary)
+            self.assertEqual(summary['load.receptor'][0], 2)
+            self.assertEqual(tracer.counters['load.points'], 300)
+            self.assertEqual(tracer.counters['controls.drawn'], 3)
+            self.assertEqual(tracer.counters['mask.randomPoints'], 4*100) # representative control and 3 controls
+            
+            file = os.path.join(path, 'trace.json')
+            tracer.save(file)
+            with open(file) as f:
+                events = json.load(f)['traceEvents']
+            self.assertIn('index.buildTree', {event['name'] for event in events})
+        
+        # Forked workers start without the tracer, even while another thread holds its lock
+        tracer = tr.enable()
+        try:
+            with tracer.lock, ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as pool:
+                self.assertFalse(pool.submit(tr.isEnabled).result(timeout=60))
+                self.assertIsNone(pool.submit(tr.count, 'worker.counter').result(timeout=60))
+        finally:
+            tr.disable()
+        self.assertNotIn('worker.counter', tracer.counters)
+
+    def test_sparseMask(self):
+        # Rectangular field larger than the camera
+        rng = np.random.default_rng(0)
+        data = np.column_stack((rng.uniform(0, 700*130, 5000), rng.uniform(0, 300*130, 5000)))
+        dense = mm.createMask(data, 130)
+        sparse = mm.createMask(data, 130, sparse=True)
+        self.assertEqual(sparse.shape, (512, 700))
+        np.testing.assert_array_equal(sparse.mask, dense.mask)
+        self.assertEqual(sparse.area, dense.area)
+        self.assertEqual(cm.hashMask(sparse), cm.hashMask(dense))
+        np.testing.assert_array_equal(sparse.randomPointsBatch(2, 500, rng=np.random.default_rng(1)),
+                                      dense.randomPointsBatch(2, 500, rng=np.random.default_rng(1)))
+        points = rng.uniform(-1000, 100000, size=(2000, 2))
+        np.testing.assert_array_equal(sparse.contains(points), dense.contains(points))
+        
+        tiles = sparse.getTiles((256, 256))
+        self.assertEqual(sum(tile.area for tile in tiles), dense.area)
+        tilePoints = tiles[1].randomPointsBatch(1, 500, rng=rng)[0]
+        self.assertTrue(dense.contains(tilePoints).all())
+        tiles, results = rm.analyzeTiles(data, sparse, (256, 350), np.arange(200, 2000, 300), 3, nWorkers=1, seed=0)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(sum(result.ripleysCurves_data['K'].shape[0] for result in results), 4*6)
+
+    def test_localRipleys(self):
+        cellMask = syntheticMask()
+        points, *__ = cellMask.randomPoints(2000, rng=np.random.default_rng(1))
+        otherPoints, *__ = cellMask.randomPoints(1000, rng=np.random.default_rng(2))
+        radii = np.arange(50, 500, 50)
+        curves = lm.computeLocalRipleys(KDTree(points), radii, cellMask, chunkSize=300, nWorkers=2)
+        nNeighbors = KDTree(points).query_ball_point(points, radii[3], return_length=True) - 1
+        density = len(points) / cellMask.area
+        np.testing.assert_allclose(curves['L'][:, 3], np.sqrt(nNeighbors / density / np.pi), rtol=1e-6)
+        # CSR points are consistent with the expectation in the mask
+        self.assertLess(abs(np.mean(curves['z'])), 0.1)
+        
+        with tempfile.TemporaryDirectory() as path:
+            with h5py.File(os.path.join(path, 'local.h5'), 'w') as f:
+                group = lm.computeLocalRipleys(points[:500], radii, cellMask, otherData=otherPoints, output=f.create_group('Receptor_1'),
+                                               chunkSize=128, backend='celllist')
+                nNeighbors = KDTree(otherPoints).query_ball_point(points[:500], radii[-1], return_length=True)
+                density = len(otherPoints) / cellMask.area
+                np.testing.assert_allclose(group['L'][:, -1], np.sqrt(nNeighbors / density / np.pi), rtol=1e-6)
+
+    def test_parallelCounting(self):
+        cellMask = syntheticMask()
+        points, *__ = cellMask.randomPoints(3000, rng=np.random.default_rng(3))
+        otherPoints, *__ = cellMask.randomPoints(2000, rng=np.random.default_rng(4))
+        radii = np.arange(50, 1000, 50)
+        tree = KDTree(points)
+        serial = tree.count_neighbors(tree, radii) - len(points)
+        for backend in ('kdtree', 'celllist'):
+            # Sums over spatial blocks equal the serial counts exactly
+            curves = rm.getRipleysCurves(points, radii, area=cellMask.area, backend=backend, nThreads=3)
+            np.testing.assert_array_equal(curves['K'], rm.getRipleysCurves(points, radii, area=cellMask.area, nNeighbors=serial)['K'])
+            counts = cnt.getBackend(backend, otherPoints, radii).countNeighbors(points, otherPoints, radii, nThreads=4)
+            np.testing.assert_array_equal(counts, tree.count_neighbors(KDTree(otherPoints), radii))
+        pointSets = [points, otherPoints, points[:10]]
+        np.testing.assert_array_equal(cnt.countPairMatrix(pointSets, radii, nThreads=2), cnt.countPairMatrix(pointSets, radii))
+        blocks = cnt.getSpatialBlocks(points, 4)
+        np.testing.assert_array_equal(np.sort(np.concatenate(blocks)), np.arange(len(points)))
+
+    def test_incrementalRipleys(self):
+        cellMask = syntheticMask()
+        points, *__ = cellMask.randomPoints(3000, rng=np.random.default_rng(5))
+        otherPoints, *__ = cellMask.randomPoints(2000, rng=np.random.default_rng(6))
+        radii = np.arange(50, 1000, 50)
+        analysis = rm.IncrementalRipleysAnalysis(radii, cellMask, 5, seed=0, refreshTolerance=0.5)
+        for batch in np.array_split(points, 10):
+            analysis.addPoints(batch)
+        full = rm.getRipleysCurves(points, radii, area=cellMask.area)
+        np.testing.assert_allclose(analysis.ripleysCurves_data['K'], full['K'])
+        # Controls are only drawn again after the number of points grew by more than 50%
+        self.assertLess(analysis.nControlRefreshes, 10)
+        
+        analysis = rm.IncrementalRipleysAnalysis(radii, cellMask, 5, cross=True, seed=0, backend='celllist')
+        analysis.addPoints(otherPoints=otherPoints[:500])
+        for batch, otherBatch in zip(np.array_split(points, 3), np.array_split(otherPoints[500:], 3)):
+            analysis.addPoints(batch, otherBatch)
+        full = rm.getRipleysCurves(points, radii, otherData=otherPoints, area=cellMask.area)
+        np.testing.assert_allclose(analysis.ripleysCurves_data['K'], full['K'])
+        with self.assertRaises(ValueError):
+            rm.IncrementalRipleysAnalysis(radii, cellMask, 5).addPoints(otherPoints=otherPoints)
+
+    def test_pairHistogram(self):
+        cellMask = syntheticMask()
+        points, *__ = cellMask.randomPoints(2000, rng=np.random.default_rng(7))
+        radii = np.arange(50, 1000, 50)
+        cache = cm.ControlCache(None)
+        reference = rm.RipleysAnalysis(points, radii, cellMask, 10, seed=0)
+        results = rm.RipleysAnalysis(points, radii, cellMask, 10, seed=0, cache=cache, histogramBinWidth=10, histogramRmax=1000)
+        # Radii on the histogram grid give the same curves as counting at radii
+        np.testing.assert_allclose(results.ripleysCurves_data['K'], reference.ripleysCurves_data['K'])
+        np.testing.assert_allclose(results.ripleysCurves_controls['K'], reference.ripleysCurves_controls['K'])
+        # Other radii up to rmax reuse the cached histograms of data and controls
+        nEntries = len(cache.memory)
+        finer = rm.RipleysAnalysis(points, np.arange(25, 1000, 25), cellMask, 10, seed=0, cache=cache, histogramBinWidth=10, histogramRmax=1000)
+        self.assertEqual(len(cache.memory), nEntries)
+        np.testing.assert_allclose(finer.ripleysCurves_data['K'][1::2], reference.ripleysCurves_data['K'])
+        with self.assertRaises(ValueError):
+            cnt.resampleCumulative(np.ones(10), np.arange(1, 11), [12])
+
+    def test_subsampledRipleys(self):
+        cellMask = syntheticMask()
+        points, *__ = cellMask.randomPoints(5000, rng=np.random.default_rng(8))
+        otherPoints, *__ = cellMask.randomPoints(3000, rng=np.random.default_rng(9))
+        radii = np.arange(100, 1000, 100)
+        exact = rm.RipleysAnalysis(points, radii, cellMask, 10, seed=0)
+        approximate = rm.RipleysAnalysis(points, radii, cellMask, 10, seed=0, subsampleSize=1000)
+        self.assertEqual(approximate.nQuery, 1000)
+        # Estimates are within a few standard errors of the exact curve
+        error = approximate.ripleysCurves_data['K'] - exact.ripleysCurves_data['K']
+        self.assertTrue(np.all(np.abs(error) < 5 * approximate.ripleysCurves_data['standardError']))
+        self.assertEqual(approximate.ripleysCurves_controls['K'].shape, exact.ripleysCurves_controls['K'].shape)
+        
+        # Automatic size for a target relative error, full counts if the target needs all points
+        auto = rm.CrossRipleysAnalysis(points, otherPoints, radii, cellMask, 5, seed=0, subsampleSize='auto', targetError=0.05, pilotSize=500)
+        self.assertTrue(500 <= auto.nQuery < len(points))
+        exactCross = rm.CrossRipleysAnalysis(points, otherPoints, radii, cellMask, 5, seed=0)
+        error = auto.ripleysCurves_data['K'] - exactCross.ripleysCurves_data['K']
+        self.assertTrue(np.all(np.abs(error) < 5 * auto.ripleysCurves_data['standardError']))
+        tight = rm.RipleysAnalysis(points, radii, cellMask, 5, seed=0, subsampleSize='auto', targetError=1e-4)
+        self.assertIsNone(tight.nQuery)
+
+    def test_symmetricMatrix(self):
+        radii = np.arange(200, 2000, 300)
+        with tempfile.TemporaryDirectory() as path:
+            cellPath = os.path.join(path, 'Cell1')
+            os.makedirs(cellPath)
+            writeSyntheticLocalizations(cellPath, 'synthetic', [1, 2, 3])
+            tasks = sch.getStudyTasks([cellPath], ['synthetic'], [1, 2, 3], symmetricMatrix=True)
+            self.assertEqual(len(tasks), 6)
+            with rs.RipleysResultStore(os.path.join(path, 'results.h5')) as store:
+                allIntegrals, __ = sch.runStudy([cellPath], ['synthetic'], [1, 2, 3], radii, nRandomControls=5, nWorkers=1, seed=0,
+                                                resultStore=store, symmetricMatrix=True)
+                cellName = rs.getCellName(cellPath, 'synthetic')
+                np.testing.assert_allclose(store.readPair(cellName, 2, 0)['dataK'], store.readPair(cellName, 0, 2)['dataK'])
+                # Controls of (k, j) randomize receptor k, the envelopes of both directions differ
+                self.assertFalse(np.array_equal(store.readPair(cellName, 2, 0)['envelopeMean'], store.readPair(cellName, 0, 2)['envelopeMean']))
+            # Whole matrix equals the full analysis, with its own checkpoints
+            with tempfile.TemporaryDirectory() as fullPath:
+                fullCellPath = os.path.join(fullPath, 'Cell1')
+                os.makedirs(fullCellPath)
+                writeSyntheticLocalizations(fullCellPath, 'synthetic', [1, 2, 3])
+                fullIntegrals, __ = sch.runStudy([fullCellPath], ['synthetic'], [1, 2, 3], radii, nRandomControls=5, nWorkers=1, seed=0)
+            np.testing.assert_allclose(fullIntegrals[0], allIntegrals[0])
+            self.assertFalse(np.allclose(allIntegrals[0], allIntegrals[0].T))
+            
+            # Cross K of the data only differs in the direction of the density normalization, which cancels
+            locData = dm.loadLocalizationData(cellPath, 'synthetic', [1, 2, 3])
+            counts = cnt.countPairMatrix(locData.data, radii)
+            np.testing.assert_array_equal(counts, counts.transpose((1, 0, 2)))
+            cellMask = mm.createMask(locData.allData, locData.pixelsize)
+            forward = rm.getRipleysCurves(locData.data[0], radii, otherData=locData.data[2], area=cellMask.area)
+            backward = rm.getRipleysCurves(locData.data[2], radii, otherData=locData.data[0], area=cellMask.area)
+            np.testing.assert_allclose(forward['K'], backward['K'])
+
+    def test_commandLine(self):
+        with tempfile.TemporaryDirectory() as path:
+            cellPath = os.path.join(path, 'Cell1')
+            os.makedirs(cellPath)
+            writeSyntheticLocalizations(cellPath, 'synthetic', [1, 2])
+            configFile = os.path.join(path, 'config.yaml')
+            with open(configFile, 'w') as f:
+                f.write(f'fileIDs: [1, 2]\nnRandomControls: 5\nradii: [200, 500, 800, 1100]\ncontrolCachePath: null\n'
+                        f'resultStorePath: {os.path.join(path, "results.h5")}\n')
+            allIntegrals, meanMatrix = ra.main([configFile, '--cells', cellPath, '--filenames', 'synthetic', '--no-figures'])
+            self.assertEqual(meanMatrix.shape, (2, 2))
+            self.assertTrue(os.path.exists(os.path.join(cellPath, 'results', 'synthetic_ripleysIntegrals.npy')))
+            with open(configFile, 'a') as f:
+                f.write('nControls: 5\n')
+            with self.assertRaises(ValueError):
+                ra.loadConfig(configFile)
+        
+        # The driver and the numerical core are imported without plotting and I/O dependencies
+        modules = subprocess.run([sys.executable, '-c', 'import sys, run_ripleysAnalysis; print(sorted(set(sys.modules) & {"matplotlib", "pandas", "yaml", "h5py", "scipy.stats"}))'],
+                                 capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+        self.assertEqual(modules.strip(), '[]')
+
+    def test_pipeline(self):
+        with tempfile.TemporaryDirectory() as path:
+            cellPaths = [os.path.join(path, f'Cell{c}') for c in range(3)]
+            for c, cellPath in enumerate(cellPaths):
+                os.makedirs(cellPath)
+                writeSyntheticLocalizations(cellPath, 'synthetic', [1, 2], seed=c)
+            config = ra.loadConfig(cellPaths=cellPaths, filenames=['synthetic']*3, fileIDs=[1, 2], nRandomControls=5, radii=[200, 500, 800, 1100],
+                                   controlCachePath=None, saveFigures=False)
+
+            # Prefetched cells and background writing give the results of the serial run
+            serialIntegrals, __ = ra.runAnalysis(dict(config, prefetchCells=0, backgroundWriter=False, resultStorePath=None))
+            # Control workers run in processes next to the loader and writer threads
+            pipelineIntegrals, __ = ra.runAnalysis(dict(config, prefetchCells=2, backgroundWriter=True, resultStorePath=os.path.join(path, 'results.h5'), nWorkers=2))
+            for serial, pipeline, cellPath in zip(serialIntegrals, pipelineIntegrals, cellPaths):
+                np.testing.assert_array_equal(serial, pipeline)
+                np.testing.assert_array_equal(np.load(os.path.join(cellPath, 'results', 'synthetic_ripleysIntegrals.npy')), pipeline)
+            with rs.RipleysResultStore(os.path.join(path, 'results.h5'), mode='r') as resultStore:
+                self.assertEqual(float(resultStore.readPair(rs.getCellName(cellPaths[2], 'synthetic'), 0, 1)['integral']), pipelineIntegrals[2][0,1])
+
+            # Errors of the loader thread reach the analysis, the result store is closed and the tracer disabled after the error
+            with self.assertRaises(FileNotFoundError), mock.patch.object(rs.RipleysResultStore, 'close', autospec=True, side_effect=rs.RipleysResultStore.close) as close:
+                ra.runAnalysis(dict(config, cellPaths=cellPaths + [os.path.join(path, 'missing')], filenames=['synthetic']*4, resultStorePath=os.path.join(path, 'failed.h5'),
+                                    traceFile=os.path.join(path, 'trace.json')))
+            close.assert_called_once()
+            self.assertFalse(tr.isEnabled())
+
+        self.assertEqual(list(pl.prefetch(lambda x: 2*x, range(5), depth=2)), [0, 2, 4, 6, 8])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Mar 28 20:41:05 2023
+
+@author: Magdalena Schneider, Janelia Research Campus
+
+Instrumentation of the pipeline stages with timed spans and counters, written as a trace file
+"""
+
+import os
+import json
+import time
+import threading
+from functools import wraps
+
+_tracer = None # active Tracer, None when tracing is disabled
+
+
+class Tracer:
+    # Collects spans (name, start, duration, attributes) and counters. The trace file uses the Chrome trace event
+    # format, it can be opened in chrome://tracing or https://ui.perfetto.dev
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def addSpan(self, name, start, duration, attrs):
+        with self.lock:
+            self.spans.append((name, start - self.start, duration, threading.get_ident(), attrs))
+
+    def addCounter(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def getSummary(self):
+        # Number of calls and total time per span name
+        summary = {}
+        for name, __, duration, __, __ in self.spans:
+            count, total = summary.get(name, (0, 0.0))
+            summary[name] = (count + 1, total + duration)
+        return summary
+
+    def getTraceEvents(self):
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'ts': start*1e6, 'dur': duration*1e6, 'pid': pid, 'tid': tid, 'args': attrs}
+                  for name, start, duration, tid, attrs in self.spans]
+        end = (time.perf_counter() - self.start) * 1e6
+        events += [{'name': name, 'ph': 'C', 'ts': end, 'pid': pid, 'args': {name: value}} for name, value in self.counters.items()]
+        return events
+
+    def save(self, file):
+        folder = os.path.dirname(file)
+        if folder and (not os.path.exists(folder)):
+            os.makedirs(folder)
+        with open(file, 'w') as f:
+            json.dump({'traceEvents': self.getTraceEvents(), 'counters': self.counters}, f, default=str)
+
+    def print(self):
+        print(f'{"stage":>30} {"calls":>8} {"time (s)":>10}')
+        for name, (count, total) in sorted(self.getSummary().items(), key=lambda item: -item[1][1]):
+            print(f'{name:>30} {count:>8} {total:>10.3f}')
+        for name, value in sorted(self.counters.items()):
+            print(f'{name:>30} {value:>19}')
+
+
+class Span:
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.addSpan(self.name, self.start, time.perf_counter() - self.start, self.attrs)
+
+
+class NullSpan:
+    # Shared span while tracing is disabled, entering and leaving it does nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_nullSpan = NullSpan()
+
+
+#%% Instrumentation
+
+def span(name, **attrs):
+    # Timed block: with span('counting.data', nPoints=n): ...
+    if _tracer is None:
+        return _nullSpan
+    return Span(_tracer, name, attrs)
+
+def count(name, value=1):
+    if _tracer is not None:
+        _tracer.addCounter(name, value)
+
+def traced(name):
+    # Decorator, the function call is a span
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            with Span(_tracer, name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+#%% Tracer control
+
+def enable():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+def disable():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+# Forked worker processes (controls, figures) start without the tracer of the parent: their spans would only be recorded
+# in a discarded copy, and a lock held by another thread of the parent at the fork would never be released in the child
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=disable)
+
+def isEnabled():
+    return _tracer is not None
+
+def getTracer():
+    return _tracer